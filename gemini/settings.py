@@ -130,7 +130,12 @@ CRON_CLASSES = [
 FEDORA = {
     "baseurl": config.FEDORA_BASEURL,
     "username": config.FEDORA_USERNAME,
-    "password": config.FEDORA_PASSWORD
+    "password": config.FEDORA_PASSWORD,
+    "upload_chunk_size": config.FEDORA_UPLOAD_CHUNK_SIZE,
+    "upload_concurrency": config.FEDORA_UPLOAD_CONCURRENCY,
+    "upload_retries": config.FEDORA_UPLOAD_RETRIES,
+    "stream_dips": config.FEDORA_STREAM_DIPS,
+    "stream_aips": config.FEDORA_STREAM_AIPS,
 }
 
 ARCHIVEMATICA = {
@@ -138,13 +143,35 @@ ARCHIVEMATICA = {
     "username": config.AM_USERNAME,
     "api_key": config.AM_API_KEY,
     "pipeline_uuids": config.AM_PIPELINE_UUIDS,
-    "location_uuids": config.AM_LOCATION_UUIDS
+    "location_uuids": config.AM_LOCATION_UUIDS,
+    "details_batch_size": config.AM_DETAILS_BATCH_SIZE,
+    "details_bulk": config.AM_DETAILS_BULK,
+    "details_concurrency": config.AM_DETAILS_CONCURRENCY,
+    "download_chunk_size": config.AM_DOWNLOAD_CHUNK_SIZE,
+    "download_retries": config.AM_DOWNLOAD_RETRIES,
+    "download_ranges": config.AM_DOWNLOAD_RANGES,
+    "download_ranges_min_size": config.AM_DOWNLOAD_RANGES_MIN_SIZE,
 }
 
 
 TMP_DIR = config.STORAGE_TMP_DIR
 DELIVERY_URL = config.DELIVERY_URL
 CLEANUP_URL = config.CLEANUP_URL
+POST_BATCH_SIZE = config.POST_BATCH_SIZE
+POST_CONCURRENCY = config.POST_CONCURRENCY
+DELIVERY_LIST_PAYLOAD = config.DELIVERY_LIST_PAYLOAD
+CLEANUP_LIST_PAYLOAD = config.CLEANUP_LIST_PAYLOAD
+ROUTINE_CONCURRENCY = config.ROUTINE_CONCURRENCY
+LEASE_DURATION = config.LEASE_DURATION
+DISK_ADMISSION = config.DISK_ADMISSION
+METS_SOURCE = config.METS_SOURCE
+PIPELINE_POLL_INTERVAL = config.PIPELINE_POLL_INTERVAL
+PIPELINE_OVERLAP = config.PIPELINE_OVERLAP
+PIPELINE_STATUS = config.PIPELINE_STATUS
+RETRY_ATTEMPTS = config.RETRY_ATTEMPTS
+RETRY_BACKOFF = config.RETRY_BACKOFF
+PACKAGE_BACKOFF = config.PACKAGE_BACKOFF
+CIRCUIT_BREAKER = config.CIRCUIT_BREAKER
 
 REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
@@ -19,7 +19,8 @@ from django.urls import include, re_path
 from rest_framework import routers
 
 from storer.views import (AddDataView, CleanupRequestView, DeliverView,
-                          DownloadView, PackageViewSet, ParseMETSView,
+                          DownloadView, FetchView, PackageViewSet,
+                          ParseMETSView, PipelineStatusView, ReapView,
                           StoreView)
 
 router = routers.DefaultRouter()
@@ -29,10 +30,13 @@ urlpatterns = [
     re_path(r'^', include(router.urls)),
     re_path(r'^add-data/', AddDataView.as_view(), name='add-data'),
     re_path(r'^download/', DownloadView.as_view(), name='download-package'),
+    re_path(r'^fetch/', FetchView.as_view(), name='fetch-package'),
     re_path(r'^parse-mets/', ParseMETSView.as_view(), name='parse-mets'),
     re_path(r'^store/', StoreView.as_view(), name='store-package'),
     re_path(r'^deliver/', DeliverView.as_view(), name='deliver-packages'),
     re_path(r'^request-cleanup/', CleanupRequestView.as_view(), name='request-cleanup'),
+    re_path(r'^reap/', ReapView.as_view(), name='reap'),
     re_path(r'^status/', PingView.as_view(), name='ping'),
+    re_path(r'^pipeline-status/', PipelineStatusView.as_view(), name='pipeline-status'),
     re_path(r'^admin/', admin.site.urls),
 ]
@@ -1,9 +1,17 @@
 import json
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from os.path import basename
+from threading import Lock
 
+import requests
 from pyfc4 import models as fcrepo
 from pyfc4.plugins.pcdm import models as pcdm
 
+from storer import resilience
+
+PREMIS_DIGEST = "http://www.loc.gov/premis/rdf/v1#hasMessageDigest"
+
 
 class FedoraClientError(Exception):
     pass
@@ -13,39 +21,307 @@ class ArchivematicaClientError(Exception):
     pass
 
 
+class ArchivematicaClient(object):
+    """Client for the Archivematica Storage Service which reuses a single
+    HTTP session for all requests. Requests are retried with backoff and
+    go through the Storage Service's circuit breaker."""
+
+    def __init__(self, baseurl, username, api_key, chunk_size=1048576, max_retries=5, pool_size=10):
+        self.baseurl = baseurl.rstrip('/')
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.session = resilience.ResilientSession()
+        self.session.headers.update({"Authorization": "ApiKey {}:{}".format(username, api_key)})
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get_package_details(self, uuid):
+        """Returns the Storage Service details of a package."""
+        try:
+            response = self.session.get("{}/api/v2/file/{}/".format(self.baseurl, uuid), timeout=60)
+            response.raise_for_status()
+            return response.json()
+        except Exception as e:
+            raise ArchivematicaClientError("Error getting details of package {}: {}".format(uuid, e))
+
+    def get_packages_details(self, uuids):
+        """Returns the Storage Service details of several packages, fetched from
+        the package list endpoint in a single request.
+
+        Returns a dict keyed by package UUID. Packages which were not found are
+        left out.
+        """
+        try:
+            response = self.session.get(
+                "{}/api/v2/file/".format(self.baseurl),
+                params={"uuid__in": ",".join(uuids), "limit": len(uuids)},
+                timeout=60)
+            response.raise_for_status()
+            return {package["uuid"]: package for package in response.json()["objects"]}
+        except Exception as e:
+            raise ArchivematicaClientError("Error getting details of packages: {}".format(e))
+
+    def download_package(self, uuid, dest, progress=None):
+        """Streams a package to `dest` in chunks.
+
+        If the connection drops, the download is resumed from the last byte
+        written using an HTTP Range request. `progress` is an optional callable
+        which receives the number of bytes written and the total size (or None
+        if the size is unknown) after each chunk. Returns the number of bytes
+        written.
+        """
+        url = "{}/api/v2/file/{}/download/".format(self.baseurl, uuid)
+        retries = 0
+        with open(dest, 'wb') as f:
+            while True:
+                try:
+                    self._stream_to_file(url, f, progress)
+                    return f.tell()
+                except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                    retries += 1
+                    if retries > self.max_retries:
+                        raise ArchivematicaClientError("Error downloading package {}: {}".format(uuid, e))
+                except requests.HTTPError as e:
+                    raise ArchivematicaClientError("Error downloading package {}: {}".format(uuid, e))
+
+    @contextmanager
+    def stream_package(self, uuid):
+        """Opens a download of a package without writing it to disk, and yields
+        an iterator over its contents in chunks. Unlike download_package, the
+        download cannot be resumed if the connection drops."""
+        url = "{}/api/v2/file/{}/download/".format(self.baseurl, uuid)
+        try:
+            response = self.session.get(url, stream=True, timeout=60)
+            response.raise_for_status()
+        except Exception as e:
+            raise ArchivematicaClientError("Error downloading package {}: {}".format(uuid, e))
+        with response:
+            yield response.iter_content(chunk_size=self.chunk_size)
+
+    def extract_file(self, uuid, relative_path, dest):
+        """Writes a single file from within a stored package to `dest`.
+
+        Unlike a full download, the Storage Service extracts the file, so the
+        request is not resumed if the connection drops.
+        """
+        url = "{}/api/v2/file/{}/extract_file/".format(self.baseurl, uuid)
+        try:
+            with self.session.get(url, params={"relative_path_to_file": relative_path}, stream=True, timeout=60) as response:
+                response.raise_for_status()
+                with open(dest, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=self.chunk_size):
+                        f.write(chunk)
+        except Exception as e:
+            raise ArchivematicaClientError("Error extracting {} from package {}: {}".format(relative_path, uuid, e))
+
+    def download_package_ranges(self, uuid, dest, size, parts, progress=None):
+        """Downloads a package as `parts` byte ranges fetched in parallel.
+
+        Ranges are written into a preallocated sparse file. Since the ranges
+        are computed from `size`, the length reported by the server, in the
+        HEAD response and in each ranged response, is checked against it.
+        Falls back to a single stream if the server does not advertise support
+        for byte ranges, in which case the number of bytes written is checked.
+        """
+        url = "{}/api/v2/file/{}/download/".format(self.baseurl, uuid)
+        headers = self.get_headers(url)
+        if headers.get("Accept-Ranges") != "bytes":
+            total = self.download_package(uuid, dest, progress)
+            if total != size:
+                raise ArchivematicaClientError("Downloaded {} bytes of package {}, expected {}".format(total, uuid, size))
+            return total
+        length = headers.get("Content-Length")
+        if length is not None and int(length) != size:
+            raise ArchivematicaClientError("Package {} is {} bytes, expected {}".format(uuid, length, size))
+        with open(dest, 'wb') as f:
+            f.truncate(size)
+        part_size = -(-size // parts)
+        ranges = [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+        lock = Lock()
+        written = 0
+
+        def range_progress(count):
+            nonlocal written
+            with lock:
+                written += count
+                if progress:
+                    progress(written, size)
+
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [executor.submit(self._download_range, url, dest, start, end, size, range_progress) for start, end in ranges]
+            return sum(future.result() for future in futures)
+
+    def get_headers(self, url):
+        """Returns the headers of a HEAD request, or an empty dict if it fails."""
+        try:
+            response = self.session.head(url, allow_redirects=True, timeout=60)
+            response.raise_for_status()
+        except requests.RequestException:
+            return {}
+        return response.headers
+
+    def _download_range(self, url, dest, start, end, size, progress):
+        """Writes bytes `start` to `end` (inclusive) of a response body into the
+        same position in `dest`, resuming if the connection drops. Raises if
+        the server reports a total length other than `size`."""
+        position = start
+        retries = 0
+        with open(dest, 'r+b') as f:
+            f.seek(start)
+            while position <= end:
+                headers = {"Range": "bytes={}-{}".format(position, end)}
+                try:
+                    with self.session.get(url, headers=headers, stream=True, timeout=60) as response:
+                        response.raise_for_status()
+                        if response.status_code != 206:
+                            raise ArchivematicaClientError("Server did not return the requested range {}".format(headers["Range"]))
+                        length = response.headers.get("Content-Range", "*").split("/")[-1]
+                        if length != "*" and int(length) != size:
+                            raise ArchivematicaClientError("Server reported a length of {} bytes, expected {}".format(length, size))
+                        for chunk in response.iter_content(chunk_size=self.chunk_size):
+                            chunk = chunk[:end + 1 - position]
+                            f.write(chunk)
+                            position += len(chunk)
+                            progress(len(chunk))
+                    if position <= end:
+                        raise requests.ConnectionError("Connection closed at byte {} of range {}".format(position, headers["Range"]))
+                except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                    retries += 1
+                    if retries > self.max_retries:
+                        raise ArchivematicaClientError("Error downloading range {}: {}".format(headers["Range"], e))
+                except requests.HTTPError as e:
+                    raise ArchivematicaClientError("Error downloading range {}: {}".format(headers["Range"], e))
+        return position - start
+
+    def _stream_to_file(self, url, f, progress):
+        """Writes a response body to `f`, requesting only the bytes after the
+        current file position. Raises ConnectionError if the body is short."""
+        offset = f.tell()
+        headers = {"Range": "bytes={}-".format(offset)} if offset else {}
+        with self.session.get(url, headers=headers, stream=True, timeout=60) as response:
+            response.raise_for_status()
+            if response.status_code == 206:
+                length = response.headers["Content-Range"].split("/")[-1]
+                total = int(length) if length != "*" else None
+            else:
+                # The server ignored the Range header, so start again.
+                f.seek(0)
+                f.truncate()
+                length = response.headers.get("Content-Length")
+                total = int(length) if length else None
+            for chunk in response.iter_content(chunk_size=self.chunk_size):
+                f.write(chunk)
+                if progress:
+                    progress(f.tell(), total)
+        if total is not None and f.tell() < total:
+            raise requests.ConnectionError("Connection closed after {} of {} bytes".format(f.tell(), total))
+
+
+@contextmanager
+def fedora_errors():
+    """pyfc4 raises a bare Exception for error responses, starting with the
+    status code. Server errors are raised as transient errors instead, so
+    they are retried and count against Fedora's circuit breaker."""
+    try:
+        yield
+    except Exception as e:
+        if str(e).startswith('HTTP 5'):
+            raise resilience.TransientError(str(e)) from e
+        raise
+
+
 class FedoraClient(object):
-    def __init__(self, root, username, password):
+    def __init__(self, root, username, password, chunk_size=1048576, pool_size=10):
+        self.root = root
         self.client = fcrepo.Repository(root, username, password, default_serialization="application/ld+json")
+        self.chunk_size = chunk_size
+        self.session = resilience.ResilientSession()
+        self.session.auth = (username, password)
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
     def retrieve(self, identifier):
-        object = self.client.get_resource(identifier)
+        object = resilience.call(self.root, self._get_resource, identifier)
         if object is False:
             raise FedoraClientError("Error retrieving object {}".format(identifier))
         return json.loads(object.data)[0]
 
     def create_container(self, uri=None):
         # uses PCDM plugin: https://github.com/ghukill/pyfc4/blob/master/pyfc4/plugins/pcdm/models.py#L121
-        specify_uri = True if uri else False
         try:
-            container = pcdm.PCDMObject(repo=self.client, uri=uri)
-            if not container.check_exists():
-                container.create(specify_uri=specify_uri, auto_refresh=False)
-            return container
+            return resilience.call(self.root, self._create_container, uri)
         except Exception as e:
             raise FedoraClientError("Error creating object: {}".format(e))
 
+    def _get_resource(self, identifier):
+        with fedora_errors():
+            return self.client.get_resource(identifier)
+
+    def _create_container(self, uri):
+        specify_uri = True if uri else False
+        container = pcdm.PCDMObject(repo=self.client, uri=uri)
+        with fedora_errors():
+            if not container.check_exists():
+                if container.status_code and container.status_code >= 500:
+                    raise Exception('HTTP {}, error checking whether resource exists'.format(container.status_code))
+                container.create(specify_uri=specify_uri, auto_refresh=False)
+        return container
+
     def create_binary(self, filepath, container, mimetype):
-        # Uses PCDM plugin: https://github.com/ghukill/pyfc4/blob/master/pyfc4/plugins/pcdm/models.py
         with open(filepath, 'rb') as f:
-            try:
-                binary = pcdm.PCDMFile(repo=self.client, uri='{}/files/{}'.format(container.uri_as_string(), basename(filepath)))
-                if binary.check_exists():
-                    binary.delete(remove_tombstone=True)
-                new_binary = pcdm.PCDMFile(repo=self.client, uri='{}/files/{}'.format(container.uri_as_string(), basename(filepath)), binary_data=f, binary_mimetype=mimetype)
-                new_binary.create(specify_uri=True, auto_refresh=False)
-                new_binary.add_triple(new_binary.rdf.prefixes.rdfs['label'], basename(filepath))
-                new_binary.add_triple(new_binary.rdf.prefixes.dc['format'], mimetype)
-                new_binary.update(auto_refresh=False)
-                return new_binary
-            except Exception as e:
-                raise FedoraClientError("Error creating binary: {}".format(e))
+            return self.upload_binary(f, basename(filepath), container, mimetype)
+
+    def upload_binary(self, fileobj, filename, container, mimetype):
+        """Streams a file object to Fedora as a binary in the container's files."""
+        return self.upload_stream(self.read_chunks(fileobj), filename, container, mimetype)
+
+    def upload_stream(self, chunks, filename, container, mimetype):
+        """Streams an iterator of bytes to Fedora as a binary in the container's files.
+
+        A PUT replaces any existing binary at the same URI, so no existence
+        check or delete is needed. Fedora does not accept triples alongside
+        binary content, so the PCDM type, label and format triples are added
+        in a single SPARQL update. Returns the URI of the binary.
+        """
+        uri = '{}/files/{}'.format(container.uri_as_string(), filename)
+        try:
+            response = self.session.put(
+                uri,
+                data=chunks,
+                headers={
+                    "Content-Type": mimetype,
+                    "Content-Disposition": 'attachment; filename={}'.format(json.dumps(filename))})
+            response.raise_for_status()
+            response = self.session.patch(
+                '{}/fcr:metadata'.format(uri),
+                data=(
+                    "PREFIX dc: <http://purl.org/dc/elements/1.1/> "
+                    "PREFIX pcdm: <http://pcdm.org/models#> "
+                    "PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#> "
+                    "INSERT {{ <> a pcdm:File ; rdfs:label {} ; dc:format {} }} WHERE {{ }}".format(
+                        json.dumps(filename), json.dumps(mimetype))),
+                headers={"Content-Type": "application/sparql-update"})
+            response.raise_for_status()
+            return uri
+        except Exception as e:
+            raise FedoraClientError("Error creating binary: {}".format(e))
+
+    def get_digest(self, uri):
+        """Returns the SHA-1 digest Fedora computed for a binary, as a hex string."""
+        try:
+            response = self.session.get('{}/fcr:metadata'.format(uri), headers={"Accept": "application/ld+json"})
+            response.raise_for_status()
+            for node in response.json():
+                for digest in node.get(PREMIS_DIGEST, []):
+                    if digest.get("@id", "").startswith("urn:sha1:"):
+                        return digest["@id"][len("urn:sha1:"):]
+        except Exception as e:
+            raise FedoraClientError("Error getting digest of binary {}: {}".format(uri, e))
+        raise FedoraClientError("No SHA-1 digest found for binary {}".format(uri))
+
+    def read_chunks(self, fileobj):
+        """Yields the contents of a file object in chunks."""
+        for chunk in iter(lambda: fileobj.read(self.chunk_size), b''):
+            yield chunk
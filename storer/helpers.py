@@ -1,35 +1,52 @@
 import json
+import logging
 import shutil
 import tarfile
+from contextlib import contextmanager
 from os import rename
-from os.path import join, splitext
+from os.path import basename, dirname, join, splitext
 
 import py7zr
 import requests
 
-from gemini import settings
+from storer import resilience
 
+logger = logging.getLogger(__name__)
+
+
+def open_7z(archive):
+    """Opens a 7z archive for reading, which reads its header index."""
+    return py7zr.SevenZipFile(archive, 'r')
+
+
+def extract_7z_mets(z, uuid, dest):
+    """Extracts the METS file from an open 7z AIP to `dest`.
+
+    The member is looked up in the header index read when the archive was
+    opened. Only the folder of the archive which holds the METS file is
+    decompressed, up to and including the METS file. Returns the destination
+    path and the estimated number of bytes decompressed.
+    """
+    directory = dirname(dest)
+    name, decompressed = locate_7z_member(z, "METS.{}.xml".format(uuid))
+    z.extract(path=directory, targets=[name])
+    rename(join(directory, name), dest)
+    if '/' in name:
+        shutil.rmtree(join(directory, name.split('/')[0]))
+    logger.info("Decompressed an estimated {} bytes to extract {} from {}".format(decompressed, name, z.filename))
+    return dest, decompressed
 
-def extract_file(archive, src, dest):
-    ext = splitext(archive)[1]
-    if ext == '.7z':
-        with py7zr.SevenZipFile(archive, 'r') as archive:
-            for name in archive.getnames():
-                if name.endswith(src):
-                    archive.extract(path=settings.TMP_DIR, targets=[name])
-                    rename(join(settings.TMP_DIR, name), dest)
-    elif ext == '.tar':
-        tf = tarfile.open(archive, mode="r")
-        for member in tf.getmembers():
-            if member.name.endswith(src):
-                outfile = open(dest, 'wb')
-                extracted = tf.extractfile(member)
-                outfile.write(extracted.read())
-                outfile.close()
-        tf.close()
-    else:
-        raise Exception("Unrecognized archive extension")
-    return dest
+
+def locate_7z_member(z, src):
+    """Returns the name of the first member of an open 7z archive ending with
+    `src`, and the estimated number of bytes which must be decompressed to
+    extract it, from the uncompressed sizes of the members preceding it."""
+    for target in z.files:
+        if target.filename.endswith(src):
+            # Solid folders must be decompressed from their start up to the target.
+            preceding = [f for f in z.files if f.folder is target.folder and not f.emptystream and f.id <= target.id]
+            return target.filename, sum(f.uncompressed for f in preceding)
+    raise FileNotFoundError("{} not found in {}".format(src, z.filename))
 
 
 def extract_all(archive, dest, tmp):
@@ -47,9 +64,44 @@ def extract_all(archive, dest, tmp):
     return dest
 
 
-def send_post_request(url, data):
-    response = requests.post(
-        url,
-        data=json.dumps(data),
-        headers={"Content-Type": "application/json"})
-    response.raise_for_status()
+@contextmanager
+def open_tar_mets(archive):
+    """Yields a file object for the first METS file in a tar archive.
+
+    The archive is read once as a stream and reading stops at the METS file,
+    which is read from the archive in chunks by whatever consumes it.
+    """
+    with tarfile.open(archive, mode="r|") as tf:
+        for member in tf:
+            name = basename(member.name)
+            if member.isfile() and name.startswith('METS.') and name.endswith('.xml'):
+                yield tf.extractfile(member)
+                return
+    raise FileNotFoundError("No METS file found in {}".format(archive))
+
+
+def iter_tar_objects(archive, filenames=None):
+    """Yields a filename and file object for each file in a DIP's `objects`
+    directory, reading the archive once as a stream without extracting it.
+
+    If `filenames` is given, only files with those names are yielded. Each file
+    object must be read before the next one is requested.
+    """
+    with tarfile.open(archive, mode="r|") as tf:
+        for member in tf:
+            path = member.name.strip('/').split('/')
+            if member.isfile() and len(path) == 3 and path[1] == 'objects':
+                if filenames is None or basename(member.name) in filenames:
+                    yield basename(member.name), tf.extractfile(member)
+
+
+def send_post_request(url, data, session=None):
+    """Sends data as JSON. Connection and server errors are retried with backoff."""
+    def post():
+        response = (session or requests).post(
+            url,
+            data=json.dumps(data),
+            headers={"Content-Type": "application/json"})
+        response.raise_for_status()
+
+    resilience.call(url, post)
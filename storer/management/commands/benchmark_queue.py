@@ -0,0 +1,85 @@
+import statistics
+import time
+from uuid import uuid4
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from storer.models import Package
+
+ACTIVE_STATUSES = (
+    Package.CREATED, Package.ADDING_DATA, Package.DATA_ADDED,
+    Package.DOWNLOADING, Package.DOWNLOADED, Package.PARSING_METS,
+    Package.METS_PARSED, Package.STORING, Package.STORED, Package.DELIVERED)
+
+
+class Command(BaseCommand):
+    """Measures the latency of the queries routines run on every poll.
+
+    The package table is filled with cleaned up packages plus a small number of
+    packages spread across the active statuses, which is the shape of a table
+    after a long time in production. All rows are created inside a transaction
+    which is rolled back once the measurements have been taken.
+    """
+    help = "Measures routine polling latency against a large package table."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rows', type=int, default=1000000,
+            help="Total number of packages to create.")
+        parser.add_argument(
+            '--active', type=int, default=1000,
+            help="Number of packages which are not cleaned up.")
+        parser.add_argument(
+            '--repeat', type=int, default=100,
+            help="Number of times each query is run.")
+        parser.add_argument(
+            '--explain', action='store_true',
+            help="Print the query plan for each query.")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.populate(options['rows'], options['active'])
+            identifier = Package.objects.filter(
+                process_status=Package.DATA_ADDED).values_list('archivematica_identifier', flat=True).first()
+            queries = {
+                'in process count': lambda: Package.objects.filter(process_status=Package.DOWNLOADING),
+                'claim': lambda: (
+                    Package.objects.select_for_update(skip_locked=True)
+                    .filter(process_status=Package.DATA_ADDED)
+                    .only('archivematica_identifier', 'process_status')
+                    .order_by('created', 'pk')[:1]),
+                'duplicate check': lambda: Package.objects.filter(archivematica_identifier=identifier),
+                'list page': lambda: Package.objects.order_by('-last_modified', '-id')[:25],
+            }
+            for name, queryset in queries.items():
+                self.measure(name, queryset, options['repeat'], options['explain'])
+            transaction.set_rollback(True)
+
+    def populate(self, rows, active, batch_size=10000):
+        start = time.perf_counter()
+        for offset in range(0, rows, batch_size):
+            Package.objects.bulk_create([
+                Package(
+                    archivematica_identifier=str(uuid4()),
+                    process_status=ACTIVE_STATUSES[i % len(ACTIVE_STATUSES)] if i < active else Package.CLEANED_UP,
+                    type='aip',
+                    data={})
+                for i in range(offset, min(offset + batch_size, rows))])
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute(f"ANALYZE {Package._meta.db_table}")
+        self.stdout.write(f"Created {rows} packages in {time.perf_counter() - start:.1f}s")
+
+    def measure(self, name, queryset, repeat, explain):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            list(queryset())
+            timings.append((time.perf_counter() - start) * 1000)
+        timings.sort()
+        self.stdout.write(
+            f"{name}: median {statistics.median(timings):.3f}ms, "
+            f"p95 {timings[int(len(timings) * 0.95) - 1]:.3f}ms")
+        if explain:
+            self.stdout.write(queryset().explain())
@@ -0,0 +1,109 @@
+from threading import Event, Thread
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+
+from gemini import settings
+from storer.routines import (AddDataRoutine, CleanupRequester, DeliverRoutine,
+                             DownloadRoutine, FetchRoutine, ParseMETSRoutine,
+                             ReapRoutine, StoreRoutine)
+
+
+class Command(BaseCommand):
+    """Runs all routines until interrupted.
+
+    Each routine runs in a loop in its own thread, so a long download or store
+    does not hold up the other stages. While a stage is moving packages its
+    loop runs continuously; once it is idle the polling interval doubles on
+    every idle run, up to the maximum interval. A stage which moves packages
+    wakes the others, so the next stage picks them up straight away.
+
+    DeliverRoutine and CleanupRequester do not claim the packages they send,
+    so only one worker should run at a time.
+
+    If `PIPELINE_OVERLAP` is set, FetchRoutine replaces DownloadRoutine, so
+    the METS files of AIPs are parsed while they are downloaded.
+    """
+    help = "Runs the package pipeline as a long-running worker."
+    routines = (ReapRoutine, AddDataRoutine, DownloadRoutine, ParseMETSRoutine,
+                StoreRoutine, DeliverRoutine, CleanupRequester)
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--min-interval', type=float, default=settings.PIPELINE_POLL_INTERVAL['min'],
+            help="Seconds to wait after the first idle run of a stage.")
+        parser.add_argument(
+            '--max-interval', type=float, default=settings.PIPELINE_POLL_INTERVAL['max'],
+            help="Maximum seconds to wait between idle runs of a stage.")
+        parser.add_argument(
+            '--once', action='store_true',
+            help="Run each stage once, in pipeline order, and exit.")
+
+    def handle(self, *args, **options):
+        routines = [self.get_routine(routine)() for routine in self.routines]
+        if options['once']:
+            close_old_connections()
+            self.run_pass(routines)
+            return
+        self.stopping = Event()
+        self.wakeups = [Event() for _ in routines]
+        threads = [
+            Thread(
+                target=self.run_stage,
+                args=(routine, wakeup, options['min_interval'], options['max_interval']),
+                name=routine.__class__.__name__,
+                daemon=True)
+            for routine, wakeup in zip(routines, self.wakeups)]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                thread.join()
+        finally:
+            self.stopping.set()
+
+    def get_routine(self, routine):
+        return FetchRoutine if (routine is DownloadRoutine and settings.PIPELINE_OVERLAP) else routine
+
+    def run_stage(self, routine, wakeup, min_interval, max_interval):
+        """Runs a routine until the worker stops, backing off while it is idle."""
+        interval = min_interval
+        try:
+            while not self.stopping.is_set():
+                wakeup.clear()
+                close_old_connections()
+                if self.run_routine(routine):
+                    interval = min_interval
+                    for other in self.wakeups:
+                        if other is not wakeup:
+                            other.set()
+                elif wakeup.wait(interval):
+                    interval = min_interval
+                else:
+                    interval = min(interval * 2, max_interval)
+        finally:
+            connection.close()
+
+    def run_pass(self, routines):
+        """Runs each routine once. Returns True if any packages were processed."""
+        busy = False
+        for routine in routines:
+            busy = self.run_routine(routine) or busy
+        return busy
+
+    def run_routine(self, routine):
+        """Runs a routine once. Returns True if any packages were processed.
+
+        Routines raise if any package they claimed failed, with the failed
+        identifiers as the second argument. Those packages were processed, so
+        the run still counts as busy.
+        """
+        try:
+            message, identifiers = routine.run()
+            if identifiers:
+                self.stdout.write(f"{message} {identifiers}")
+                return True
+        except Exception as e:
+            self.stderr.write(f"{routine.__class__.__name__}: {e.args[0] if e.args else e}")
+            return len(e.args) > 1 and bool(e.args[1])
+        return False
@@ -0,0 +1,57 @@
+# Generated by Django 4.2.16 on 2026-10-18 03:42
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def move_mimetypes_to_files(apps, schema_editor):
+    Package = apps.get_model('storer', 'Package')
+    MimeType = apps.get_model('storer', 'MimeType')
+    PackageFile = apps.get_model('storer', 'PackageFile')
+    mimetype_ids = {}
+    for package in Package.objects.filter(mimetypes__isnull=False).only('id', 'mimetypes').iterator():
+        files = []
+        for uuid, name in package.mimetypes.items():
+            if name not in mimetype_ids:
+                mimetype_ids[name] = MimeType.objects.get_or_create(name=name)[0].id
+            files.append(PackageFile(package_id=package.id, uuid=uuid, mimetype_id=mimetype_ids[name]))
+        PackageFile.objects.bulk_create(files, batch_size=5000)
+
+
+def move_files_to_mimetypes(apps, schema_editor):
+    Package = apps.get_model('storer', 'Package')
+    PackageFile = apps.get_model('storer', 'PackageFile')
+    for package in Package.objects.filter(files__isnull=False).distinct().iterator():
+        package.mimetypes = dict(PackageFile.objects.filter(package=package).values_list('uuid', 'mimetype__name'))
+        package.save(update_fields=['mimetypes'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storer', '0008_package_mimetypes_alter_package_origin'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MimeType',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PackageFile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uuid', models.CharField(max_length=36)),
+                ('mimetype', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='storer.mimetype')),
+                ('package', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='files', to='storer.package')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='packagefile',
+            constraint=models.UniqueConstraint(fields=('package', 'uuid'), name='unique_package_file'),
+        ),
+        migrations.RunPython(move_mimetypes_to_files, move_files_to_mimetypes),
+    ]
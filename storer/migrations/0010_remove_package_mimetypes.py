@@ -0,0 +1,17 @@
+# Generated by Django 4.2.16 on 2026-10-18 03:42
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storer', '0009_package_files'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='package',
+            name='mimetypes',
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.16 on 2026-10-18 04:12
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def check_duplicate_identifiers(apps, schema_editor):
+    """Stops the migration if packages share an identifier, since the unique
+    constraint cannot be added until the duplicates are resolved."""
+    Package = apps.get_model('storer', 'Package')
+    duplicates = list(
+        Package.objects.exclude(archivematica_identifier__isnull=True)
+        .values('archivematica_identifier')
+        .annotate(count=Count('id'))
+        .filter(count__gt=1)
+        .values_list('archivematica_identifier', flat=True)[:20])
+    if duplicates:
+        raise RuntimeError(
+            "Packages with duplicate archivematica_identifier values must be removed "
+            "before this migration can run: {}".format(", ".join(duplicates)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storer', '0010_remove_package_mimetypes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='package',
+            index=models.Index(condition=models.Q(('process_status', 30), _negated=True), fields=['process_status', 'created', 'id'], name='storer_package_queue_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='package',
+            index=models.Index(fields=['-last_modified', '-id'], name='storer_package_modified_idx'),
+        ),
+        migrations.RunPython(check_duplicate_identifiers, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='package',
+            constraint=models.UniqueConstraint(fields=('archivematica_identifier',), name='unique_archivematica_identifier'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.16 on 2026-10-18 05:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storer', '0011_package_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='package',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='package',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
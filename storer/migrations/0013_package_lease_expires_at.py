@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16 on 2026-10-18 06:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storer', '0012_package_attempts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='package',
+            name='lease_expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.16 on 2026-10-18 09:12
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def copy_last_modified(apps, schema_editor):
+    Package = apps.get_model('storer', 'Package')
+    Package.objects.update(status_changed_at=models.F('last_modified'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storer', '0013_package_lease_expires_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='package',
+            name='status_changed_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(copy_last_modified, migrations.RunPython.noop),
+    ]
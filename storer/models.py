@@ -1,5 +1,6 @@
 from asterism.models import BasePackage
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
 
 
 class Package(BasePackage):
@@ -9,6 +10,8 @@ class Package(BasePackage):
     ADDING_DATA = 1
     DATA_ADDED = 2
     DOWNLOADING = 5
+    FETCHING = 6
+    METS_FETCHED = 7
     DOWNLOADED = 10
     PARSING_METS = 11
     METS_PARSED = 12
@@ -19,6 +22,8 @@ class Package(BasePackage):
     PROCESS_STATUS_CHOICES = (
         (CREATED, 'Package created'),
         (DOWNLOADING, 'Package being downloaded'),
+        (FETCHING, 'Package being downloaded while its METS is parsed'),
+        (METS_FETCHED, 'Package METS parsed, package waiting to be downloaded'),
         (DOWNLOADED, 'Package downloaded'),
         (STORING, 'Package being stored'),
         (STORED, 'Package stored'),
@@ -29,4 +34,73 @@ class Package(BasePackage):
     internal_sender_identifier = models.CharField(max_length=60, null=True, blank=True)
     fedora_uri = models.CharField(max_length=255, null=True, blank=True)
     archivesspace_uri = models.CharField(max_length=255, null=True, blank=True)
-    mimetypes = models.JSONField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(null=True, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    # Unlike last_modified, only set when a package moves on to a new status.
+    status_changed_at = models.DateTimeField(default=timezone.now)
+    _mimetypes = None
+    _mimetypes_changed = False
+
+    class Meta(BasePackage.Meta):
+        indexes = [
+            # Routines poll for the oldest package in a status. Cleaned up
+            # packages (status 30) are never polled for, so the index skips them.
+            models.Index(
+                fields=['process_status', 'created', 'id'],
+                name='storer_package_queue_idx',
+                condition=~models.Q(process_status=30)),
+            models.Index(fields=['-last_modified', '-id'], name='storer_package_modified_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['archivematica_identifier'], name='unique_archivematica_identifier'),
+        ]
+
+    @property
+    def mimetypes(self):
+        """Dict of file UUIDs and mimetypes.
+
+        Stored as PackageFile rows, which are only loaded when this property is
+        first read.
+        """
+        if self._mimetypes is None and self.pk:
+            self._mimetypes = dict(self.files.values_list('uuid', 'mimetype__name'))
+        return self._mimetypes
+
+    @mimetypes.setter
+    def mimetypes(self, value):
+        self._mimetypes = value
+        self._mimetypes_changed = True
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        if self._mimetypes_changed:
+            self.save_mimetypes()
+
+    def save_mimetypes(self):
+        """Replaces this package's PackageFile rows with its current mimetypes."""
+        with transaction.atomic():
+            self.files.all().delete()
+            if self._mimetypes:
+                names = set(self._mimetypes.values())
+                MimeType.objects.bulk_create([MimeType(name=name) for name in names], ignore_conflicts=True)
+                mimetype_ids = dict(MimeType.objects.filter(name__in=names).values_list('name', 'id'))
+                PackageFile.objects.bulk_create(
+                    [PackageFile(package=self, uuid=uuid, mimetype_id=mimetype_ids[name]) for uuid, name in self._mimetypes.items()],
+                    batch_size=5000)
+        self._mimetypes_changed = False
+
+
+class MimeType(models.Model):
+    name = models.CharField(max_length=255, unique=True)
+
+
+class PackageFile(models.Model):
+    package = models.ForeignKey(Package, on_delete=models.CASCADE, related_name='files')
+    uuid = models.CharField(max_length=36)
+    mimetype = models.ForeignKey(MimeType, on_delete=models.PROTECT)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['package', 'uuid'], name='unique_package_file'),
+        ]
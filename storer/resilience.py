@@ -0,0 +1,179 @@
+import logging
+import random
+import time
+from threading import Lock
+from urllib.parse import urlsplit
+
+import requests
+
+from gemini import settings
+
+logger = logging.getLogger(__name__)
+
+REPLAYABLE_BODIES = (type(None), str, bytes, dict, list, tuple)
+
+
+class TransientError(Exception):
+    """Raised for errors which are expected to clear if the call is retried."""
+    pass
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an endpoint whose circuit breaker is open."""
+
+    def __init__(self, endpoint, retry_at):
+        super().__init__("Circuit open for {}, not retrying for {:.0f} seconds".format(endpoint, max(retry_at - time.monotonic(), 0)))
+        self.endpoint = endpoint
+        self.retry_at = retry_at
+
+
+class CircuitBreaker(object):
+    """Tracks consecutive failed calls to an endpoint.
+
+    After `failure_threshold` consecutive failures the circuit opens and calls
+    fail immediately for `reset_timeout` seconds. After that a single trial
+    call is let through: if it succeeds the circuit closes, otherwise it opens
+    again for another `reset_timeout` seconds.
+    """
+
+    def __init__(self, endpoint, failure_threshold=5, reset_timeout=60):
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = Lock()
+
+    @property
+    def retry_at(self):
+        return self.opened_at + self.reset_timeout if self.opened_at is not None else None
+
+    def before_call(self):
+        """Raises CircuitOpenError if the endpoint should not be called."""
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if self.trial_running or time.monotonic() < self.retry_at:
+                raise CircuitOpenError(self.endpoint, self.retry_at)
+            self.trial_running = True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_error(self):
+        """Records a call which failed without showing whether the endpoint
+        is working, so any trial call can be made again."""
+        with self.lock:
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.warning(f"Opening circuit for {self.endpoint} after {self.failures} failures")
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+
+
+_breakers = {}
+_breakers_lock = Lock()
+
+
+def get_endpoint(url):
+    """Returns the scheme and host of a URL, which identify its endpoint."""
+    parts = urlsplit(url)
+    return "{}://{}".format(parts.scheme, parts.netloc)
+
+
+def get_breaker(url):
+    """Returns the circuit breaker shared by all calls to the endpoint of `url`
+    made from this process."""
+    endpoint = get_endpoint(url)
+    with _breakers_lock:
+        if endpoint not in _breakers:
+            _breakers[endpoint] = CircuitBreaker(
+                endpoint,
+                failure_threshold=settings.CIRCUIT_BREAKER['failure_threshold'],
+                reset_timeout=settings.CIRCUIT_BREAKER['reset_timeout'])
+        return _breakers[endpoint]
+
+
+def backoff_delay(attempt, base, maximum):
+    """Returns a delay before retry number `attempt` (starting at 1).
+
+    The delay doubles with each attempt up to `maximum`. Up to half of it is
+    random, so that callers which failed at the same time do not all retry at
+    the same time.
+    """
+    delay = min(maximum, base * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def is_transient(exception):
+    """Returns True for errors which are worth retrying: connection failures,
+    timeouts, rate limiting and server errors."""
+    if isinstance(exception, (TransientError, requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(exception, requests.HTTPError) and exception.response is not None:
+        return exception.response.status_code == 429 or exception.response.status_code >= 500
+    return False
+
+
+def call(url, func, *args, retries=None, **kwargs):
+    """Calls `func` through the circuit breaker for the endpoint of `url`.
+
+    Transient errors are retried up to `retries` times (by default
+    `RETRY_ATTEMPTS`) with exponential backoff and jitter. Other errors are
+    raised immediately. Client error responses show the endpoint is working,
+    so they count as a success; errors which did not come from a response
+    count as neither.
+    """
+    breaker = get_breaker(url)
+    retries = settings.RETRY_ATTEMPTS if retries is None else retries
+    attempt = 0
+    while True:
+        breaker.before_call()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if not is_transient(e):
+                if isinstance(e, requests.HTTPError) and e.response is not None:
+                    breaker.record_success()
+                else:
+                    breaker.record_error()
+                raise
+            breaker.record_failure()
+            attempt += 1
+            if attempt > retries:
+                raise
+            delay = backoff_delay(attempt, settings.RETRY_BACKOFF['base'], settings.RETRY_BACKOFF['max'])
+            logger.info(f"Retrying call to {get_endpoint(url)} in {delay:.1f}s after error: {e}")
+            time.sleep(delay)
+        else:
+            breaker.record_success()
+            return result
+
+
+class ResilientSession(requests.Session):
+    """Session which sends every request through `call`.
+
+    Server errors are raised as HTTPError so they can be retried. Requests
+    whose body is a stream cannot be replayed, so they are sent once, but
+    still count towards the endpoint's circuit breaker.
+    """
+
+    def request(self, method, url, *args, **kwargs):
+        retries = None if isinstance(kwargs.get('data'), REPLAYABLE_BODIES) else 0
+        return call(url, self.send_request, method, url, *args, retries=retries, **kwargs)
+
+    def send_request(self, method, url, *args, **kwargs):
+        response = super().request(method, url, *args, **kwargs)
+        if response.status_code == 429 or response.status_code >= 500:
+            response.close()
+            response.raise_for_status()
+        return response
@@ -1,128 +1,547 @@
-import tarfile
-from os import W_OK, access, listdir
-from os.path import basename, isdir, join
-from shutil import move
+import hashlib
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta
+from functools import lru_cache
+from os import listdir
+from os.path import join
+from threading import Event, Lock, Thread
 from xml.etree import ElementTree as ET
 
-from amclient import AMClient, errors
-from asterism.file_helpers import remove_file_or_dir
+import requests
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
 
 from gemini import settings
-from storer import helpers
-from storer.clients import FedoraClient
+from storer import helpers, resilience
+from storer.clients import ArchivematicaClient, FedoraClient
 from storer.models import Package
+from storer.workspace import WorkspaceError, get_workspace_manager
+
+logger = logging.getLogger(__name__)
+
+METS_NS = 'http://www.loc.gov/METS/'
+FITS_NS = 'http://hul.harvard.edu/ois/xml/ns/fits/fits_output'
+METS_AMDSEC = f'{{{METS_NS}}}amdSec'
+METS_MDWRAP = f'{{{METS_NS}}}mdWrap'
+METS_XMLDATA = f'{{{METS_NS}}}xmlData'
+STATUS_FIELDS = ['process_status', 'last_modified']
+ATTEMPT_FIELDS = ['attempts', 'next_attempt_at', 'lease_expires_at', 'status_changed_at']
+EXTRACTED_DIR = 'extracted'
+METS_COST_CACHE_KEY = 'mets-cost-{}'
+DISK_WAIT_CACHE_KEY = 'disk-wait-{}'
+RESERVED_STATUSES = (Package.DOWNLOADING, Package.FETCHING, Package.DOWNLOADED, Package.PARSING_METS, Package.METS_PARSED, Package.STORING)
+
+
+@lru_cache()
+def get_premis_paths(version):
+    """Returns the paths of the object identifier and FITS identity of a
+    PREMIS object, in the namespace for its version."""
+    premis = '{http://www.loc.gov/premis/v3}' if version.startswith("3.") else '{info:lc/xmlns/premis-v2}'
+    fits = f'{{{FITS_NS}}}'
+    return (
+        f'{premis}objectIdentifier/{premis}objectIdentifierValue',
+        f'{premis}objectCharacteristics/{premis}objectCharacteristicsExtension/{fits}fits/{fits}identification/{fits}identity')
 
 
 class RoutineError(Exception):
     pass
 
 
+def record_attempt(package, exception=None):
+    """Records the outcome of an attempt to process a package, and releases
+    its lease.
+
+    A package which failed is set aside until its backoff, which doubles with
+    each consecutive failure, has elapsed. A successful attempt resets it, and
+    records when the package moved on to its new status.
+    """
+    package.lease_expires_at = None
+    if exception is None:
+        package.attempts = 0
+        package.next_attempt_at = None
+        package.status_changed_at = timezone.now()
+    else:
+        package.attempts += 1
+        delay = resilience.backoff_delay(package.attempts, settings.PACKAGE_BACKOFF['base'], settings.PACKAGE_BACKOFF['max'])
+        package.next_attempt_at = timezone.now() + timedelta(seconds=delay)
+
+
+def ready_for_attempt():
+    """Filters out packages which have been set aside after failing."""
+    return Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=timezone.now())
+
+
+def lease_expiry():
+    return timezone.now() + timedelta(seconds=settings.LEASE_DURATION)
+
+
+def is_remote_package(package):
+    """Packages outside the configured locations are not downloaded."""
+    location = package.data['current_location'].split('/')[-2]
+    return not (location in settings.ARCHIVEMATICA['location_uuids'])
+
+
+def is_streamed_aip(package):
+    """AIPs are streamed to Fedora without being downloaded if `stream_aips`
+    is set. Their METS files are fetched separately."""
+    return package.type == 'aip' and settings.FEDORA['stream_aips'] and not is_remote_package(package)
+
+
 class CleanupError(Exception):
     pass
 
 
 class Routine:
     """
-    Base class for routines which checks existence and permissions of tmp directory.
+    Base class for routines. Files for each package are kept in a workspace
+    directory for the package under the tmp directory, whose existence and
+    permissions are checked once per process.
+
+    Packages are claimed using row-level locks, so several workers can run the
+    same routine without handling a package twice. The number of packages
+    handled at once is limited by the `ROUTINE_CONCURRENCY` setting for the
+    routine's stage.
+
+    Claimed packages hold a lease of `LEASE_DURATION` seconds, which is
+    extended while they are being handled. If a worker dies, the lease expires
+    and ReapRoutine returns the package to `start_status`. Packages are only
+    saved while the worker still holds their lease, so a worker whose lease
+    expired cannot overwrite a package which has since been reaped or claimed
+    again.
+
+    Subclasses declare the package fields they read in `fields` and the fields
+    they change in `updated_fields`; no other columns are loaded or saved.
+    Routines which handle packages in batches set `batch_size`, and may claim
+    `batch_size` packages for each unit of concurrency.
     """
+    updated_fields = ()
+    batch_size = 1
 
     def __init__(self):
-        self.tmp_dir = settings.TMP_DIR
-        if not isdir(self.tmp_dir):
-            raise RoutineError('Directory does not exist', self.tmp_dir)
-        if not access(self.tmp_dir, W_OK):
-            raise RoutineError('Directory does not have write permissions', self.tmp_dir)
+        try:
+            self.workspaces = get_workspace_manager(settings.TMP_DIR)
+        except WorkspaceError as e:
+            raise RoutineError(*e.args)
+        self.concurrency = settings.ROUTINE_CONCURRENCY.get(self.stage, 1)
+        self.lease_lock = Lock()
+        self.lease = None
+        self.held = set()
 
     def run(self):
-        """Main method. Processes only one package at a time."""
-        if not Package.objects.filter(process_status=self.in_process_status).exists():
-            package = Package.objects.filter(process_status=self.start_status).first()
-            if package:
+        """Main method. Processes as many packages as the concurrency limit allows."""
+        in_process = Package.objects.filter(process_status=self.in_process_status, lease_expires_at__gt=timezone.now())
+        slots = self.concurrency * self.batch_size - in_process.count()
+        if slots < 1:
+            return ("Service currently running", None)
+        packages = self.claim_packages(slots)
+        if not packages:
+            return (self.idle_message, None)
+        with self.heartbeat(packages):
+            errors = self.process_packages(packages)
+        if len(errors) == 1:
+            identifier, exception = errors[0]
+            raise Exception(str(exception), identifier)
+        elif errors:
+            raise Exception(
+                "; ".join(f"{identifier}: {exception}" for identifier, exception in errors),
+                [identifier for identifier, _ in errors])
+        return (self.success_message, [package.archivematica_identifier for package in packages])
+
+    def claim_packages(self, limit):
+        """Atomically moves up to `limit` packages into `in_process_status`.
+
+        Rows locked by another worker, and packages set aside after failing,
+        are skipped.
+        """
+        with transaction.atomic():
+            packages = self.admit_packages(
+                Package.objects.select_for_update(skip_locked=True)
+                .filter(ready_for_attempt(), process_status__in=self.waiting_statuses)
+                .only(*self.fields, *ATTEMPT_FIELDS)
+                .order_by('created', 'pk'), limit)
+            now = timezone.now()
+            expires = lease_expiry()
+            for package in packages:
                 package.process_status = self.in_process_status
-                package.save()
-                try:
-                    self.handle_package(package)
-                    end_status = getattr(self, 'end_status') if hasattr(self, 'end_status') else self.get_end_status(package)
-                    package.process_status = end_status
-                    package.save()
-                    message = self.success_message
-                except Exception as e:
-                    package.process_status = self.start_status
-                    package.save()
-                    raise Exception(str(e), package.archivematica_identifier)
-            else:
-                message = self.idle_message
+                package.last_modified = now
+                package.lease_expires_at = expires
+            Package.objects.filter(pk__in=[package.pk for package in packages]).update(
+                process_status=self.in_process_status, last_modified=now, lease_expires_at=expires)
+        self.lease = expires
+        self.held = set(package.pk for package in packages)
+        return packages
+
+    @property
+    def waiting_statuses(self):
+        """Statuses of packages this routine claims."""
+        return (self.start_status,)
+
+    def admit_packages(self, waiting, limit):
+        """Returns the packages to claim from `waiting`, oldest first."""
+        return list(waiting[:limit])
+
+    @contextmanager
+    def heartbeat(self, packages):
+        """Extends the leases of packages while they are being handled.
+
+        Leases are extended from a separate thread every third of
+        `LEASE_DURATION`, so a slow download or upload keeps its lease.
+        Packages whose lease was lost in the meantime are no longer extended.
+        """
+        stop = Event()
+
+        def extend_leases():
+            try:
+                while not stop.wait(settings.LEASE_DURATION / 3):
+                    try:
+                        self.extend_leases(packages)
+                    except Exception as e:
+                        logger.warning(f"Error extending leases: {e}")
+            finally:
+                connection.close()
+
+        thread = Thread(target=extend_leases, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def extend_leases(self, packages):
+        with self.lease_lock:
+            expires = lease_expiry()
+            extended = Package.objects.filter(
+                pk__in=self.held, process_status=self.in_process_status, lease_expires_at=self.lease).update(
+                lease_expires_at=expires)
+            if extended < len(self.held):
+                still_held = set(Package.objects.filter(pk__in=self.held, lease_expires_at=expires).values_list('pk', flat=True))
+                for package in packages:
+                    if package.pk in self.held - still_held:
+                        logger.warning(f"Lost lease on package {package.archivematica_identifier} in {self.stage}")
+                self.held = still_held
+            self.lease = expires
+
+    def save_claimed(self, packages, fields, release=True):
+        """Saves packages whose lease this worker still holds, and returns the
+        packages whose lease was lost, which are not saved.
+
+        Packages are released unless `release` is False, so their leases are
+        no longer extended.
+        """
+        if not packages:
+            return []
+        with self.lease_lock, transaction.atomic():
+            held = set(
+                Package.objects.select_for_update()
+                .filter(pk__in=[package.pk for package in packages], process_status=self.in_process_status, lease_expires_at=self.lease)
+                .values_list('pk', flat=True))
+            saved = [package for package in packages if package.pk in held]
+            if len(saved) == 1:
+                saved[0].save(update_fields=fields)
+            elif saved:
+                Package.objects.bulk_update(saved, fields)
+            if release:
+                self.held.difference_update(package.pk for package in packages)
+        lost = [package for package in packages if package.pk not in held]
+        for package in lost:
+            logger.warning(f"Not saving package {package.archivematica_identifier}, its lease in {self.stage} was lost")
+        return lost
+
+    def process_packages(self, packages):
+        """Handles claimed packages, in separate threads if there is more than one.
+
+        Returns a list of (identifier, exception) tuples for failed packages.
+        """
+        if len(packages) == 1:
+            results = [self.process_package(packages[0])]
         else:
-            message = "Service currently running"
-            package = None
-        return (message, [package.archivematica_identifier] if package else None)
+            with ThreadPoolExecutor(max_workers=len(packages)) as executor:
+                results = list(executor.map(self.process_package_in_thread, packages))
+        return [result for result in results if result]
+
+    def process_package(self, package):
+        try:
+            self.handle_package(package)
+            package.process_status = self.get_end_status(package)
+            record_attempt(package)
+            error = None
+            fields = STATUS_FIELDS + ATTEMPT_FIELDS + list(self.updated_fields)
+        except Exception as e:
+            package.process_status = self.get_failed_status(package)
+            record_attempt(package, e)
+            error = e
+            fields = STATUS_FIELDS + ATTEMPT_FIELDS
+        if self.save_claimed([package], fields):
+            return (package.archivematica_identifier, RoutineError("Lease expired while the package was being handled"))
+        if error:
+            return (package.archivematica_identifier, error)
+
+    def process_package_in_thread(self, package):
+        """Closes the thread's database connection once the package is handled."""
+        try:
+            return self.process_package(package)
+        finally:
+            connection.close()
 
     def get_end_status(self, package):
+        if hasattr(self, 'end_status'):
+            return self.end_status
         raise NotImplementedError('get_end_status has not been implemented on this class.')
 
+    def get_failed_status(self, package):
+        """Returns the status of a package which could not be handled."""
+        return self.start_status
+
+    def discard_partial_files(self, uuid):
+        """Removes files left in the tmp directory by an interrupted attempt
+        to handle a package. Files needed by `start_status` are kept."""
+        pass
+
 
 class AddDataRoutine(Routine):
+    stage = 'add_data'
     start_status = Package.CREATED
     in_process_status = Package.ADDING_DATA
+    fields = ('archivematica_identifier', 'process_status')
+    updated_fields = ('type', 'fedora_uri', 'data')
     success_message = "Data added to package."
     idle_message = "No packages waiting for data to be added."
 
     def get_end_status(self, package):
         """
         Dynamically determines end_status. If package location is not in
-        expected list, bypasses download routine.
+        expected list, or the package is a streamed AIP, bypasses download routine.
         """
-        location = package.data['current_location'].split('/')[-2]
-        return Package.DATA_ADDED if (location in settings.ARCHIVEMATICA['location_uuids']) else Package.DOWNLOADED
+        return Package.DOWNLOADED if (is_remote_package(package) or is_streamed_aip(package)) else Package.DATA_ADDED
 
-    def handle_package(self, package):
-        """Gets information about a package from Archivematica."""
-        am_client = AMClient(
-            ss_api_key=settings.ARCHIVEMATICA['api_key'],
-            ss_user_name=settings.ARCHIVEMATICA['username'],
-            ss_url=settings.ARCHIVEMATICA['baseurl'],
-            directory=self.tmp_dir)
-
-        am_client.package_uuid = package.archivematica_identifier
-        package_data = am_client.get_package_details()
-        if isinstance(package_data, int):
-            raise Exception(errors.error_lookup(package_data))
+    def __init__(self):
+        super().__init__()
+        self.batch_size = settings.ARCHIVEMATICA['details_batch_size']
+        self.archivematica_client = ArchivematicaClient(
+            baseurl=settings.ARCHIVEMATICA['baseurl'],
+            username=settings.ARCHIVEMATICA['username'],
+            api_key=settings.ARCHIVEMATICA['api_key'],
+            pool_size=settings.ARCHIVEMATICA['details_concurrency'])
+
+    def process_packages(self, packages):
+        """Fetches details of all claimed packages from Archivematica, then
+        saves the packages which were found with a single query."""
+        details = self.get_packages_details([package.archivematica_identifier for package in packages])
+        added = []
+        errors = []
+        for package in packages:
+            try:
+                self.add_data(package, details[package.archivematica_identifier])
+                package.process_status = self.get_end_status(package)
+                record_attempt(package)
+                added.append(package)
+            except Exception as e:
+                package.process_status = self.start_status
+                record_attempt(package, e)
+                errors.append((package, e))
+            package.last_modified = timezone.now()
+        lost = self.save_claimed(added, STATUS_FIELDS + ATTEMPT_FIELDS + list(self.updated_fields))
+        lost += self.save_claimed([package for package, _ in errors], STATUS_FIELDS + ATTEMPT_FIELDS)
+        lost_error = RoutineError("Lease expired while the package was being handled")
+        return [(package.archivematica_identifier, lost_error if package in lost else e) for package, e in errors] + [
+            (package.archivematica_identifier, lost_error) for package in lost if package in added]
+
+    def get_packages_details(self, uuids):
+        """Returns a dict of package details, or the exception raised while
+        fetching them, keyed by package UUID.
+
+        Details are fetched from the package list endpoint in batches. If that
+        fails, or `details_bulk` is off, packages are fetched concurrently one
+        request at a time.
+        """
+        if settings.ARCHIVEMATICA['details_bulk']:
+            try:
+                details = {}
+                for start in range(0, len(uuids), self.batch_size):
+                    details.update(self.archivematica_client.get_packages_details(uuids[start:start + self.batch_size]))
+                return {uuid: details.get(uuid, RoutineError(f"Package {uuid} not found in Archivematica")) for uuid in uuids}
+            except Exception as e:
+                logger.warning(f"Error getting details of packages in bulk, getting them individually: {e}")
+        with ThreadPoolExecutor(max_workers=settings.ARCHIVEMATICA['details_concurrency']) as executor:
+            return dict(zip(uuids, executor.map(self.get_package_details, uuids)))
+
+    def get_package_details(self, uuid):
+        """Returns the details of a package, or the exception raised."""
+        try:
+            return self.archivematica_client.get_package_details(uuid)
+        except Exception as e:
+            return e
 
+    def add_data(self, package, package_data):
+        """Adds information about a package from Archivematica."""
+        if isinstance(package_data, Exception):
+            raise package_data
         package.type = package_data['package_type'].lower()
         package.fedora_uri = package_data['resource_uri']  # this gets overwritten if package is stored in Fedora
         package.data = package_data
 
 
 class DownloadRoutine(Routine):
-    """Downloads a package from Archivematica."""
+    """Downloads a package from Archivematica.
+
+    Packages whose METS data was already parsed by FetchRoutine are moved on
+    to METS_PARSED once downloaded.
+    """
+    stage = 'download'
     start_status = Package.DATA_ADDED
     in_process_status = Package.DOWNLOADING
-    end_status = Package.DOWNLOADED
+    fields = ('archivematica_identifier', 'process_status', 'type', 'data')
     success_message = "Package downloaded."
     idle_message = "No packages waiting to be downloaded."
 
-    def handle_package(self, package):
+    def __init__(self):
+        super().__init__()
+        self.archivematica_client = ArchivematicaClient(
+            baseurl=settings.ARCHIVEMATICA['baseurl'],
+            username=settings.ARCHIVEMATICA['username'],
+            api_key=settings.ARCHIVEMATICA['api_key'],
+            chunk_size=settings.ARCHIVEMATICA['download_chunk_size'],
+            max_retries=settings.ARCHIVEMATICA['download_retries'])
+
+    @property
+    def waiting_statuses(self):
+        return (Package.DATA_ADDED, Package.METS_FETCHED)
 
-        am_client = AMClient(
-            ss_api_key=settings.ARCHIVEMATICA['api_key'],
-            ss_user_name=settings.ARCHIVEMATICA['username'],
-            ss_url=settings.ARCHIVEMATICA['baseurl'],
-            directory=self.tmp_dir)
+    def get_end_status(self, package):
+        return Package.METS_PARSED if package.mets_fetched else Package.DOWNLOADED
+
+    def get_failed_status(self, package):
+        return Package.METS_FETCHED if package.mets_fetched else Package.DATA_ADDED
+
+    def admit_packages(self, waiting, limit):
+        """Claims packages only if the tmp directory has space for them.
 
+        Up to `DISK_ADMISSION['candidates']` waiting packages are considered,
+        oldest first. A package which does not fit is skipped, so smaller
+        packages can be downloaded while it waits for space. Once the oldest
+        skipped package has waited `DISK_ADMISSION['max_wait']` seconds, no
+        packages behind it are admitted until it fits. Packages which could
+        never fit on the filesystem are skipped without holding others back.
+
+        Files already in a package's workspace, such as a partial download or
+        a METS file, are replaced or kept when it is downloaded, so they are
+        credited against the space it needs.
+        """
+        available = self.available_space()
+        capacity = self.workspaces.total_space() - settings.DISK_ADMISSION['headroom']
+        packages = []
+        waiting_for_space = None
+        for package in waiting[:max(limit, settings.DISK_ADMISSION['candidates'])]:
+            uuid = package.archivematica_identifier
+            required = max(self.required_space(package) - self.workspaces.usage(uuid), 0)
+            if required > capacity:
+                logger.warning(f"Package {uuid} needs {required} bytes, more than the {capacity} bytes which can be used")
+                continue
+            if required > available:
+                if waiting_for_space is None:
+                    waiting_for_space = (package, required)
+                    if self.waited_for_space(package) >= settings.DISK_ADMISSION['max_wait']:
+                        logger.info(f"Package {uuid} has waited too long for disk space, not admitting smaller packages")
+                        break
+                continue
+            cache.delete(DISK_WAIT_CACHE_KEY.format(uuid))
+            available -= required
+            packages.append(package)
+            if len(packages) == limit:
+                break
+        if waiting_for_space:
+            package, required = waiting_for_space
+            logger.info(f"Package {package.archivematica_identifier} needs {required} bytes, {max(available, 0)} available; waiting for disk space")
+        for package in packages:
+            package.mets_fetched = package.process_status == Package.METS_FETCHED
+        return packages
+
+    def waited_for_space(self, package):
+        """Returns the number of seconds since a package was first skipped for
+        lack of disk space."""
+        key = DISK_WAIT_CACHE_KEY.format(package.archivematica_identifier)
+        cache.add(key, time.time(), None)
+        return time.time() - cache.get(key, time.time())
+
+    def required_space(self, package):
+        """Returns the space a package needs in the tmp directory until it is
+        stored. DIPs which are extracted before storing need twice their size."""
+        size = package.data.get('size') or 0
+        if package.type == 'dip' and not settings.FEDORA['stream_dips']:
+            return size * 2
+        return size
+
+    def available_space(self):
+        """Returns the free space in the tmp directory, less the headroom and
+        the space still needed by packages between download and storage.
+
+        Downloads in progress are measured from their workspaces. Space used
+        by DIPs being extracted is counted twice until they are stored.
+        """
+        reserved = 0
+        for package in Package.objects.filter(process_status__in=RESERVED_STATUSES).only('archivematica_identifier', 'process_status', 'type', 'data'):
+            if is_remote_package(package):
+                continue
+            if package.process_status in (Package.DOWNLOADING, Package.FETCHING):
+                written = self.workspaces.usage(package.archivematica_identifier)
+            else:
+                written = package.data.get('size') or 0
+            reserved += max(self.required_space(package) - written, 0)
+        return self.workspaces.free_space() - settings.DISK_ADMISSION['headroom'] - reserved
+
+    def handle_package(self, package):
+        """Streams the package directly to its final path in the tmp directory."""
         if self.is_downloadable(package.data):
+            uuid = package.archivematica_identifier
+            filename = f"{uuid}{self.get_extension(package.type)}"
             try:
-                download_path = am_client.download_package(package.archivematica_identifier)
-                tmp_path = join(
-                    self.tmp_dir, f"{package.archivematica_identifier}{self.get_extension(package.type)}")
-                move(download_path, tmp_path)
+                dest = join(self.workspaces.create(uuid), filename)
+                size = package.data.get('size')
+                if self.use_ranges(size):
+                    self.archivematica_client.download_package_ranges(
+                        uuid, dest, size, settings.ARCHIVEMATICA['download_ranges'],
+                        progress=self.progress_logger(uuid))
+                else:
+                    self.archivematica_client.download_package(
+                        uuid, dest, progress=self.progress_logger(uuid))
             except Exception as e:
+                # Downloads start from the beginning, so partial files only take up space.
+                self.workspaces.discard(uuid, filename)
                 raise RoutineError(f"Error downloading data: {e}")
         else:
             raise RoutineError(f"Package {package.archivematica_identifier} is not downloadable")
 
+    def use_ranges(self, size):
+        """Packages over a configured size are downloaded as parallel byte ranges."""
+        if settings.ARCHIVEMATICA['download_ranges'] < 2 or not size:
+            return False
+        return size >= settings.ARCHIVEMATICA['download_ranges_min_size']
+
+    def progress_logger(self, uuid):
+        """Returns a callable which logs download progress every 10 percent."""
+        last_logged = 0
+
+        def log_progress(written, total):
+            nonlocal last_logged
+            if total:
+                percent = written * 100 // total
+                if percent >= last_logged + 10:
+                    last_logged = percent - percent % 10
+                    logger.info(f"Downloaded {written} of {total} bytes of package {uuid}")
+        return log_progress
+
     def get_extension(self, package_type):
         return '.tar' if package_type == 'dip' else '.7z'
 
+    def discard_partial_files(self, uuid):
+        self.workspaces.remove(uuid)
+
     def is_downloadable(self, package):
         pipeline = package['origin_pipeline'].split('/')[-2]
         return (pipeline in settings.ARCHIVEMATICA['pipeline_uuids'])
@@ -130,83 +549,164 @@ class DownloadRoutine(Routine):
 
 class ParseMETSRoutine(Routine):
     """Parses data from a METS file."""
+    stage = 'parse_mets'
     start_status = Package.DOWNLOADED
     in_process_status = Package.PARSING_METS
+    fields = ('archivematica_identifier', 'process_status', 'type', 'data')
+    updated_fields = ('internal_sender_identifier', 'origin', 'archivesspace_uri')
     success_message = "METS data parsed."
     idle_message = "No packages waiting for METS parsing."
 
+    def __init__(self):
+        super().__init__()
+        self.archivematica_client = ArchivematicaClient(
+            baseurl=settings.ARCHIVEMATICA['baseurl'],
+            username=settings.ARCHIVEMATICA['username'],
+            api_key=settings.ARCHIVEMATICA['api_key'],
+            chunk_size=settings.ARCHIVEMATICA['download_chunk_size'])
+
     def get_end_status(self, package):
         return Package.STORED if self.is_remote_package(package) else Package.METS_PARSED
 
     def handle_package(self, package):
-        self.uuid = package.archivematica_identifier
-        self.upload = True
-
-        if self.is_remote_package(package):
-            mets_path = self.get_remote_mets(package)
+        uuid = package.archivematica_identifier
+        if self.is_remote_package(package) or is_streamed_aip(package):
+            # Nothing else uses the workspace of packages which are not downloaded.
+            try:
+                mets_data = self.parse_mets(self.get_remote_mets(package))
+            finally:
+                self.workspaces.remove(uuid)
+        elif package.type == 'dip':
+            with helpers.open_tar_mets(self.workspaces.path(uuid, f"{uuid}.tar")) as mets_file:
+                mets_data = self.parse_mets(mets_file)
         else:
-            mets_path = self.get_mets_from_package(package.type)
+            mets_data = self.parse_mets(self.get_aip_mets(package))
+
+        self.set_mets_data(package, mets_data)
 
-        mets_data = self.parse_mets(mets_path)
+    def get_aip_mets(self, package):
+        """Returns the path of the METS file of a downloaded AIP, fetched or
+        extracted according to the policy in `METS_SOURCE`. The archive is
+        opened once, both to choose the source and to extract the file."""
+        if settings.METS_SOURCE['policy'] == 'remote':
+            return self.get_remote_mets(package)
+        uuid = package.archivematica_identifier
+        with helpers.open_7z(self.workspaces.path(uuid, f"{uuid}.7z")) as archive:
+            if not self.use_remote_mets(package, archive):
+                return self.get_mets_from_package(package, archive)
+        return self.get_remote_mets(package)
 
+    def set_mets_data(self, package, mets_data):
         package.mimetypes = mets_data['mimetypes']
         package.internal_sender_identifier = mets_data['internal_sender_identifier']
         package.origin = mets_data['origin']
         package.archivesspace_uri = mets_data['archivesspace_uri']
-        # TODO do we need to clean up here?
 
     def is_remote_package(self, package):
-        location = package.data['current_location'].split('/')[-2]
-        return not (location in settings.ARCHIVEMATICA['location_uuids'])
+        return is_remote_package(package)
+
+    def use_remote_mets(self, package, archive):
+        """
+        Chooses whether to fetch the METS file of a downloaded AIP from the
+        Storage Service instead of extracting it from the open `archive`,
+        according to the policy in `METS_SOURCE`.
+
+        With the "auto" policy, the time to extract the METS file is estimated
+        from the number of bytes which must be decompressed to reach it, and
+        compared with the average time to fetch a METS file. A source which
+        has not been measured is used so that it is.
+        """
+        policy = settings.METS_SOURCE['policy']
+        if policy != 'auto':
+            return policy == 'remote'
+        uuid = package.archivematica_identifier
+        costs = cache.get_many([METS_COST_CACHE_KEY.format('local'), METS_COST_CACHE_KEY.format('remote')])
+        seconds_per_byte = costs.get(METS_COST_CACHE_KEY.format('local'))
+        remote_seconds = costs.get(METS_COST_CACHE_KEY.format('remote'))
+        if seconds_per_byte is None:
+            return False
+        if remote_seconds is None:
+            return True
+        try:
+            _, decompressed = helpers.locate_7z_member(archive, f"METS.{uuid}.xml")
+        except Exception as e:
+            logger.warning(f"Error finding METS file in package {uuid}, fetching it: {e}")
+            return True
+        return remote_seconds < seconds_per_byte * decompressed
+
+    def record_cost(self, source, cost):
+        """Updates the moving average of the cost of getting METS files from `source`."""
+        key = METS_COST_CACHE_KEY.format(source)
+        average = cache.get(key)
+        weight = settings.METS_SOURCE['weight']
+        cache.set(key, cost if average is None else weight * cost + (1 - weight) * average, settings.METS_SOURCE['timeout'])
 
     def get_remote_mets(self, package):
-        mets_path = "METS.{}.xml".format(self.uuid)
-        am_client = AMClient(
-            ss_api_key=settings.ARCHIVEMATICA['api_key'],
-            ss_user_name=settings.ARCHIVEMATICA['username'],
-            ss_url=settings.ARCHIVEMATICA['baseurl'],
-            package_uuid=self.uuid,
-            relative_path=join('data', mets_path),
-            saveas_filename=mets_path,
-            directory=self.tmp_dir)
-        am_client.extract_file()
-        return join(self.tmp_dir, mets_path)
-
-    def get_mets_from_package(self, package_type):
-        if package_type == 'aip':
-            extension = '.7z'
-            mets_source_path = "METS.{}.xml".format(self.uuid)
-        else:
-            extension = '.tar'
-            tf = tarfile.open(join(self.tmp_dir, "{}.tar".format(self.uuid)))
-            mets_source_path = [f for f in tf.getnames() if (basename(f).startswith('METS.') and basename(f).endswith('.xml'))][0]
-        return helpers.extract_file(
-            join(self.tmp_dir, f"{self.uuid}{extension}"),
-            mets_source_path,
-            join(self.tmp_dir, "METS.{}.xml".format(self.uuid)))
+        """Fetches the METS file of a package from the Storage Service, and
+        records the time taken if it succeeds."""
+        uuid = package.archivematica_identifier
+        mets_path = "METS.{}.xml".format(uuid)
+        dest = join(self.workspaces.create(uuid), mets_path)
+        start = time.monotonic()
+        self.archivematica_client.extract_file(uuid, join('data', mets_path), dest)
+        self.record_cost('remote', time.monotonic() - start)
+        return dest
+
+    def get_mets_from_package(self, package, archive):
+        """Extracts the METS file from the open archive of an AIP, and records
+        the time taken per byte decompressed."""
+        uuid = package.archivematica_identifier
+        start = time.monotonic()
+        mets_path, decompressed = helpers.extract_7z_mets(archive, uuid, self.workspaces.path(uuid, "METS.{}.xml".format(uuid)))
+        if decompressed:
+            self.record_cost('local', (time.monotonic() - start) / decompressed)
+        return mets_path
 
     def parse_mets(self, mets_path):
         """
         Parses Archivematica's METS file and returns the Internal-Sender-Identifier
         submitted in a bag-info.txt file, as well as a dict of filename UUIDs
-        and mimetypes
+        and mimetypes. `mets_path` can be a path or a file object.
+
+        The file is parsed incrementally. BagIt metadata and PREMIS objects
+        are kept until they have been read, and every other element is
+        removed from its parent as soon as it ends, so memory use does not
+        grow with the number of files described in the METS, other than
+        through the dict of mimetypes.
         """
         try:
             mets_data = {}
-            ns = {'mets': 'http://www.loc.gov/METS/', 'fits': 'http://hul.harvard.edu/ois/xml/ns/fits/fits_output'}
-            tree = ET.parse(mets_path)
-            bagit_root = tree.find("mets:amdSec/mets:sourceMD/mets:mdWrap[@OTHERMDTYPE='BagIt']/mets:xmlData/transfer_metadata", ns)
-            mets_data['internal_sender_identifier'] = self.findtext_with_exception(bagit_root, "Internal-Sender-Identifier", ns)
-            mets_data['archivesspace_uri'] = bagit_root.findtext("ArchivesSpace-URI", namespaces=ns)
-            mets_data['origin'] = bagit_root.findtext("Origin", default="aurora", namespaces=ns)
-            files_root = tree.findall('mets:amdSec/mets:techMD/mets:mdWrap[@MDTYPE="PREMIS:OBJECT"]/mets:xmlData/', ns)
             mimetypes = {}
-            for f in files_root:
-                ns['premis'] = self.get_premis_schemalocation(f.attrib['version'])
-                uuid = f.find('premis:objectIdentifier/premis:objectIdentifierValue', ns).text
-                identity = f.find('premis:objectCharacteristics/premis:objectCharacteristicsExtension/fits:fits/fits:identification/fits:identity', ns)
-                mtype = identity.attrib.get('mimetype', 'application/octet-stream') if identity else 'application/octet-stream'
-                mimetypes.update({uuid: mtype})
+            bagit_root = None
+            ancestors = []
+            kept_depth = None
+            for event, element in ET.iterparse(mets_path, events=('start', 'end')):
+                if event == 'start':
+                    if kept_depth is None and self.is_read_metadata(ancestors):
+                        kept_depth = len(ancestors)
+                    ancestors.append(element)
+                    continue
+                ancestors.pop()
+                if kept_depth is not None and len(ancestors) > kept_depth:
+                    # Descendants of kept elements are read with them.
+                    continue
+                if len(ancestors) == kept_depth:
+                    kept_depth = None
+                    if self.is_mets_metadata(ancestors, 'sourceMD', 'OTHERMDTYPE', 'BagIt'):
+                        if bagit_root is None and element.tag == 'transfer_metadata':
+                            bagit_root = element
+                            mets_data['internal_sender_identifier'] = self.findtext_with_exception(bagit_root, "Internal-Sender-Identifier", {})
+                            mets_data['archivesspace_uri'] = bagit_root.findtext("ArchivesSpace-URI")
+                            mets_data['origin'] = bagit_root.findtext("Origin", default="aurora")
+                    else:
+                        uuid_path, identity_path = get_premis_paths(element.attrib['version'])
+                        identity = element.find(identity_path)
+                        mtype = identity.attrib.get('mimetype', 'application/octet-stream') if identity is not None else 'application/octet-stream'
+                        mimetypes[element.find(uuid_path).text] = mtype
+                if ancestors:
+                    ancestors[-1].remove(element)
+            if bagit_root is None:
+                raise RoutineError("No BagIt metadata found")
             mets_data['mimetypes'] = mimetypes
             return mets_data
         except FileNotFoundError:
@@ -216,112 +716,371 @@ class ParseMETSRoutine(Routine):
         except Exception as e:
             raise RoutineError("Error getting data from Archivematica METS file: {}".format(e))
 
+    def is_read_metadata(self, ancestors):
+        """Checks whether the element with the given ancestors is BagIt metadata or a PREMIS object."""
+        return self.is_mets_metadata(ancestors, 'sourceMD', 'OTHERMDTYPE', 'BagIt') or self.is_mets_metadata(ancestors, 'techMD', 'MDTYPE', 'PREMIS:OBJECT')
+
+    def is_mets_metadata(self, ancestors, section, type_attribute, type_value):
+        """Checks whether the element with the given ancestors is a direct child of
+        `mets:amdSec/{section}/mets:mdWrap[@{type_attribute}='{type_value}']/mets:xmlData`."""
+        if len(ancestors) != 5:
+            return False
+        amdsec, md_section, md_wrap, xml_data = ancestors[1:]
+        return all([
+            amdsec.tag == METS_AMDSEC,
+            md_section.tag == f'{{{METS_NS}}}{section}',
+            md_wrap.tag == METS_MDWRAP,
+            md_wrap.attrib.get(type_attribute) == type_value,
+            xml_data.tag == METS_XMLDATA])
+
     def findtext_with_exception(self, element, xpath, namespaces):
         ret = element.findtext(xpath, namespaces=namespaces)
         if not ret:
             raise ValueError(xpath)
         return ret
 
-    def get_premis_schemalocation(self, version):
-        """Returns a PREMIS schema URL based on the version number provided."""
-        return 'http://www.loc.gov/premis/v3' if version.startswith("3.") else 'info:lc/xmlns/premis-v2'
+    def discard_partial_files(self, uuid):
+        self.workspaces.discard(uuid, "METS.{}.xml".format(uuid))
 
-    def clean_up(self, uuid, src_file=False):
-        """Removes directories for a given transfer. If `src_file` argument is
-        true, removes source file and extracted METS matching the UUID as well."""
-        for d in listdir(self.tmp_dir):
-            if uuid in d and (src_file or isdir(join(self.tmp_dir, d))):
-                remove_file_or_dir(join(self.tmp_dir, d))
+
+class FetchRoutine(DownloadRoutine):
+    """Downloads a package while its METS file is fetched from the Storage
+    Service and parsed, so storage can start once the download finishes.
+
+    If only one of the two succeeds, the package is left in a status from
+    which the other can be retried: DOWNLOADED for ParseMETSRoutine, or
+    METS_FETCHED for this routine or DownloadRoutine, which then only
+    download it. DIPs, whose
+    METS files are read from the downloaded archive, are only downloaded.
+    """
+    stage = 'fetch'
+    start_status = Package.DATA_ADDED
+    in_process_status = Package.FETCHING
+    fields = DownloadRoutine.fields + ParseMETSRoutine.updated_fields
+    updated_fields = ParseMETSRoutine.updated_fields
+    success_message = "Package downloaded and METS data parsed."
+
+    def __init__(self):
+        super().__init__()
+        self.parser = ParseMETSRoutine()
+
+    def admit_packages(self, waiting, limit):
+        packages = super().admit_packages(waiting, limit)
+        for package in packages:
+            package.downloaded = False
+        return packages
+
+    def get_end_status(self, package):
+        return Package.METS_PARSED if package.type == 'aip' else Package.DOWNLOADED
+
+    def get_failed_status(self, package):
+        return Package.DOWNLOADED if package.downloaded else super().get_failed_status(package)
+
+    def handle_package(self, package):
+        """Downloads the package in this thread while its METS file is fetched
+        in another. METS data is saved even if the download fails."""
+        if package.type != 'aip' or package.mets_fetched:
+            super().handle_package(package)
+            package.downloaded = True
+            return
+        download_error = None
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            mets = executor.submit(self.fetch_mets, package)
+            try:
+                super().handle_package(package)
+                package.downloaded = True
+            except Exception as e:
+                download_error = e
+            mets_error = mets.exception()
+        package.mets_fetched = mets_error is None
+        if not package.downloaded:
+            if package.mets_fetched:
+                self.save_claimed([package], self.updated_fields, release=False)
+            raise download_error
+        if mets_error:
+            raise mets_error
+
+    def fetch_mets(self, package):
+        """Fetches and parses the METS file of a package from the Storage Service."""
+        self.parser.set_mets_data(package, self.parser.parse_mets(self.parser.get_remote_mets(package)))
 
 
 class StoreRoutine(Routine):
     """Uploads the contents of a package to Fedora.
 
-    AIPS are uploaded as single 7z files. DIPs are extracted and each file is
-    uploaded. Only one package is processed at a time.
+    AIPS are uploaded as single 7z files, either from disk or streamed from
+    Archivematica. DIPs are extracted and each file is uploaded.
     """
+    stage = 'store'
     start_status = Package.METS_PARSED
     in_process_status = Package.STORING
     end_status = Package.STORED
+    fields = ('archivematica_identifier', 'process_status', 'type', 'data')
+    updated_fields = ('fedora_uri',)
     success_message = "Package stored."
     idle_message = "No packages to store."
 
-    def handle_package(self, package):
+    def __init__(self):
+        super().__init__()
         self.fedora_client = FedoraClient(root=settings.FEDORA['baseurl'],
                                           username=settings.FEDORA['username'],
-                                          password=settings.FEDORA['password'])
-        self.uuid = package.archivematica_identifier
+                                          password=settings.FEDORA['password'],
+                                          chunk_size=settings.FEDORA['upload_chunk_size'],
+                                          pool_size=settings.FEDORA['upload_concurrency'])
+        self.archivematica_client = ArchivematicaClient(
+            baseurl=settings.ARCHIVEMATICA['baseurl'],
+            username=settings.ARCHIVEMATICA['username'],
+            api_key=settings.ARCHIVEMATICA['api_key'],
+            chunk_size=settings.FEDORA['upload_chunk_size'])
 
-        if package.type == 'dip':
-            self.extracted = helpers.extract_all(join(self.tmp_dir, "{}.tar".format(self.uuid)), join(self.tmp_dir, self.uuid), self.tmp_dir)
+    def handle_package(self, package):
+        uuid = package.archivematica_identifier
+
+        if package.type == 'dip' and not settings.FEDORA['stream_dips']:
+            workspace = self.workspaces.path(uuid)
+            helpers.extract_all(join(workspace, "{}.tar".format(uuid)), join(workspace, EXTRACTED_DIR), workspace)
 
         try:
-            container = self.fedora_client.create_container(self.uuid)
-            getattr(self, 'store_{}'.format(package.type))(package.data, container, package.mimetypes)
+            container = self.fedora_client.create_container(uuid)
+            getattr(self, 'store_{}'.format(package.type))(package, container)
         except Exception as e:
-            self.clean_up(self.uuid)
+            self.discard_partial_files(uuid)
             raise RoutineError("Error storing data: {}".format(e))
 
         package.fedora_uri = container.uri_as_string()
-        self.clean_up(self.uuid, True)
+        self.workspaces.remove(uuid)
 
-    def clean_up(self, uuid, src_file=False):
-        """Removes directories for a given transfer. If `src_file` argument is
-        true, removes source file and extracted METS matching the UUID as well."""
-        for d in listdir(self.tmp_dir):
-            if uuid in d and (src_file or isdir(join(self.tmp_dir, d))):
-                remove_file_or_dir(join(self.tmp_dir, d))
+    def discard_partial_files(self, uuid):
+        self.workspaces.discard(uuid, EXTRACTED_DIR)
 
-    def store_aip(self, package, container, mimetypes):
+    def store_aip(self, package, container):
         """
         Stores an AIP as a single binary in Fedora and handles the resulting URI.
         Assumes AIPs are stored as a compressed package.
         """
-        self.fedora_client.create_binary(
-            join(self.tmp_dir, f"{self.uuid}.7z"),
-            container,
-            'application/x-7z-compressed')
+        uuid = package.archivematica_identifier
+        if is_streamed_aip(package):
+            self.stream_aip(package, container)
+        else:
+            self.fedora_client.create_binary(
+                self.workspaces.path(uuid, f"{uuid}.7z"),
+                container,
+                'application/x-7z-compressed')
+
+    def stream_aip(self, package, container):
+        """
+        Streams an AIP from Archivematica to Fedora without writing it to disk.
+        The SHA-1 digest of the bytes sent is computed as they are read, and
+        compared with the digest Fedora computed for the binary.
+        """
+        uuid = package.archivematica_identifier
+        sha1 = hashlib.sha1()
+        size = 0
 
-    def store_dip(self, package, container, mimetypes):
+        def tee(chunks):
+            nonlocal size
+            for chunk in chunks:
+                sha1.update(chunk)
+                size += len(chunk)
+                yield chunk
+
+        with self.archivematica_client.stream_package(uuid) as chunks:
+            uri = self.fedora_client.upload_stream(tee(chunks), f"{uuid}.7z", container, 'application/x-7z-compressed')
+        expected_size = package.data.get('size')
+        if expected_size and size != expected_size:
+            raise RoutineError(f"Streamed {size} bytes of package {uuid}, expected {expected_size}")
+        digest = self.fedora_client.get_digest(uri)
+        if digest != sha1.hexdigest():
+            raise RoutineError(f"Digest of binary {uri} is {digest}, expected {sha1.hexdigest()}")
+
+    def store_dip(self, package, container):
         """
         Stores a DIP as multiple binaries in Fedora and handles the resulting URI.
         Matches the file UUID (the first 36 characters of the filename) against
         the mimetypes dictionary to find the relevant mimetype.
+
+        Files are either uploaded concurrently from the extracted DIP, or
+        streamed one at a time from the DIP archive without extracting it. Files
+        which fail to upload are retried without uploading the rest of the
+        package again.
         """
-        for f in listdir(join(self.extracted, 'objects')):
-            mimetype = mimetypes[f[0:36]]
-            self.fedora_client.create_binary(
-                join(self.tmp_dir, self.uuid, 'objects', f),
-                container,
-                mimetype)
+        uuid = package.archivematica_identifier
+        mimetypes = package.mimetypes
+        if settings.FEDORA['stream_dips']:
+            archive = self.workspaces.path(uuid, f"{uuid}.tar")
+            errors = self.stream_files(archive, container, mimetypes)
+            for _ in range(settings.FEDORA['upload_retries']):
+                if not errors:
+                    break
+                errors = self.stream_files(archive, container, mimetypes, list(errors))
+        else:
+            objects_dir = self.workspaces.path(uuid, EXTRACTED_DIR, 'objects')
+            errors = self.upload_files(listdir(objects_dir), objects_dir, container, mimetypes)
+            for _ in range(settings.FEDORA['upload_retries']):
+                if not errors:
+                    break
+                errors = self.upload_files(list(errors), objects_dir, container, mimetypes)
+        if errors:
+            raise RoutineError("Error storing {} files: {}".format(
+                len(errors), "; ".join(f"{filename}: {e}" for filename, e in errors.items())))
+
+    def stream_files(self, archive, container, mimetypes, filenames=None):
+        """Uploads files from the `objects` directory of a DIP archive as they
+        are read from it. Returns a dict of exceptions keyed by the name of the
+        file which failed to upload."""
+        errors = {}
+        for filename, fileobj in helpers.iter_tar_objects(archive, filenames):
+            try:
+                self.fedora_client.upload_binary(fileobj, filename, container, mimetypes[filename[0:36]])
+            except Exception as e:
+                errors[filename] = e
+        return errors
+
+    def upload_files(self, filenames, objects_dir, container, mimetypes):
+        """Uploads files using a bounded thread pool. Returns a dict of
+        exceptions keyed by the name of the file which failed to upload."""
+        def upload(filename):
+            try:
+                self.fedora_client.create_binary(
+                    join(objects_dir, filename),
+                    container,
+                    mimetypes[filename[0:36]])
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=settings.FEDORA['upload_concurrency']) as executor:
+            results = list(executor.map(upload, filenames))
+        return {filename: e for filename, e in zip(filenames, results) if e}
+
+
+class ReapRoutine(object):
+    """Returns packages whose lease has expired, because the worker handling
+    them stopped, to the start status of their stage, and removes any partial
+    files they left behind. Downloads whose METS data was already saved return
+    to METS_FETCHED, so it is not fetched again. The interrupted attempt counts as a failure, so
+    packages which repeatedly crash workers are backed off."""
+    routines = (AddDataRoutine, DownloadRoutine, FetchRoutine, ParseMETSRoutine, StoreRoutine)
+    success_message = "Packages with expired leases returned to their start status."
+    idle_message = "No packages with expired leases."
+
+    def __init__(self):
+        self.stages = {routine.in_process_status: routine() for routine in self.routines}
+
+    def run(self):
+        with transaction.atomic():
+            packages = list(
+                Package.objects.select_for_update(skip_locked=True)
+                .filter(
+                    Q(lease_expires_at__isnull=True) | Q(lease_expires_at__lte=timezone.now()),
+                    process_status__in=list(self.stages))
+                .only('archivematica_identifier', 'process_status', 'internal_sender_identifier', *ATTEMPT_FIELDS))
+            now = timezone.now()
+            interrupted = []
+            for package in packages:
+                routine = self.stages[package.process_status]
+                logger.warning(f"Lease on package {package.archivematica_identifier} expired in {routine.stage}")
+                interrupted.append((routine, package.archivematica_identifier))
+                package.process_status = self.get_start_status(routine, package)
+                package.last_modified = now
+                record_attempt(package, RoutineError("Lease expired"))
+            Package.objects.bulk_update(packages, STATUS_FIELDS + ATTEMPT_FIELDS)
+        for routine, uuid in interrupted:
+            routine.discard_partial_files(uuid)
+        msg = self.success_message if packages else self.idle_message
+        return (msg, [package.archivematica_identifier for package in packages])
+
+    def get_start_status(self, routine, package):
+        if Package.METS_FETCHED in routine.waiting_statuses and package.internal_sender_identifier:
+            return Package.METS_FETCHED
+        return routine.start_status
 
 
 class PostRoutine(object):
     """Base Routine for sending POST requests to another service. Exposes a
-    `get_data()` method for adding data into POST requests."""
+    `get_data()` method for adding data into POST requests. Subclasses declare
+    the package fields `get_data()` reads in `fields`.
+
+    Packages are sent in batches of `POST_BATCH_SIZE`. If the service accepts
+    lists (`list_payload`) each batch is sent as one request, otherwise its
+    packages are sent concurrently one request at a time. A package which
+    cannot be sent does not stop the others from being sent.
+    """
+
+    def __init__(self):
+        self.batch_size = settings.POST_BATCH_SIZE
+        self.concurrency = settings.POST_CONCURRENCY
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
     def run(self):
+        packages = list(
+            Package.objects.filter(ready_for_attempt(), process_status=self.start_status)
+            .only(*self.fields, *ATTEMPT_FIELDS)
+            .order_by('created', 'pk'))
         package_ids = []
-        for package in Package.objects.filter(process_status=self.start_status):
-            try:
-                data = self.get_data(package)
-                helpers.send_post_request(self.url, data)
-            except Exception as e:
-                raise RoutineError(
-                    "Error sending POST request to {}: {}".format(
-                        self.url, e), package.internal_sender_identifier)
-            package.process_status = self.end_status
-            package.save()
-            package_ids.append(package.internal_sender_identifier)
+        errors = []
+        for start in range(0, len(packages), self.batch_size):
+            batch = packages[start:start + self.batch_size]
+            failed = self.send_batch(batch)
+            failed_pks = [package.pk for package, _ in failed]
+            sent = [package for package in batch if package.pk not in failed_pks]
+            now = timezone.now()
+            for package in sent:
+                package.process_status = self.end_status
+                record_attempt(package)
+            for package, e in failed:
+                record_attempt(package, e)
+            for package in batch:
+                package.last_modified = now
+            Package.objects.bulk_update(batch, STATUS_FIELDS + ATTEMPT_FIELDS)
+            package_ids += [package.internal_sender_identifier for package in sent]
+            errors += [(package.internal_sender_identifier, e) for package, e in failed]
+        if len(errors) == 1:
+            identifier, exception = errors[0]
+            raise RoutineError(
+                "Error sending POST request to {}: {}".format(self.url, exception), identifier)
+        elif errors:
+            raise RoutineError(
+                "Error sending POST requests to {}: {}".format(
+                    self.url, "; ".join(f"{identifier}: {exception}" for identifier, exception in errors)),
+                [identifier for identifier, _ in errors])
         msg = self.success_message if len(package_ids) else self.idle_message
         return (msg, package_ids)
 
+    def send_batch(self, packages):
+        """Sends a batch of packages.
+
+        Returns a list of (package, exception) tuples for packages which were
+        not sent. If a list request fails its packages are retried one at
+        a time, so that a single bad package does not hold back the others.
+        """
+        if self.list_payload:
+            try:
+                helpers.send_post_request(self.url, [self.get_data(package) for package in packages], self.session)
+                return []
+            except Exception as e:
+                logger.warning(f"Error sending batch to {self.url}, sending packages individually: {e}")
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            results = list(executor.map(self.send_package, packages))
+        return [(package, e) for package, e in zip(packages, results) if e]
+
+    def send_package(self, package):
+        """Sends a single package. Returns the exception raised, if any."""
+        try:
+            helpers.send_post_request(self.url, self.get_data(package), self.session)
+        except Exception as e:
+            return e
+
 
 class DeliverRoutine(PostRoutine):
     """Delivers package data to next service."""
     start_status = Package.STORED
     end_status = Package.DELIVERED
+    fields = ('internal_sender_identifier', 'process_status', 'fedora_uri', 'type', 'origin', 'archivesspace_uri')
     url = settings.DELIVERY_URL
+    list_payload = settings.DELIVERY_LIST_PAYLOAD
     success_message = "All package data delivered."
     idle_message = "No package data waiting to be delivered."
 
@@ -337,7 +1096,9 @@ class CleanupRequester(PostRoutine):
     """Requests cleanup of packages from previous service."""
     start_status = Package.DELIVERED
     end_status = Package.CLEANED_UP
+    fields = ('internal_sender_identifier', 'process_status')
     url = settings.CLEANUP_URL
+    list_payload = settings.CLEANUP_LIST_PAYLOAD
     success_message = "Requests sent to clean up Packages."
     idle_message = "No packages waiting for cleanup."
 
@@ -3,14 +3,35 @@ from rest_framework import serializers
 from storer.models import Package
 
 
-class PackageSerializer(serializers.HyperlinkedModelSerializer):
+def get_requested_fields(request):
+    """Returns the set of field names in a comma-separated `fields` query
+    parameter, or None if no fields were requested."""
+    if request is None or not request.query_params.get('fields'):
+        return None
+    return set(name.strip() for name in request.query_params['fields'].split(',') if name.strip())
+
+
+class SparseFieldsMixin(object):
+    """Returns only the fields named in the `fields` query parameter, if one
+    was passed. Unknown field names are ignored."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        requested = get_requested_fields(self.context.get('request'))
+        if requested:
+            for name in set(self.fields) - requested:
+                self.fields.pop(name)
+
+
+class PackageSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
+    mimetypes = serializers.JSONField(read_only=True)
 
     class Meta:
         model = Package
         fields = '__all__'
 
 
-class PackageListSerializer(serializers.HyperlinkedModelSerializer):
+class PackageListSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
 
     class Meta:
         model = Package
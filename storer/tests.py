@@ -1,20 +1,36 @@
+import hashlib
+import tracemalloc
+from datetime import timedelta
+from io import BytesIO, StringIO
 from os import listdir, makedirs
-from os.path import isdir, join
+from os.path import basename, getsize, isdir, isfile, join, splitext
 from shutil import copyfile, rmtree
-from unittest.mock import patch
+from threading import Event
+from unittest.mock import MagicMock, patch
 
+import py7zr
+import requests
+from django.core.cache import cache
+from django.core.management import call_command
 from django.test import TestCase
 from django.urls import reverse
+from django.utils import timezone
 from pyfc4 import models as fcrepo
 from pyfc4.plugins.pcdm import models as pcdm
 from rest_framework.test import APIRequestFactory
 
 from gemini import settings
 
-from .models import Package
+from . import helpers, resilience
+from .clients import (ArchivematicaClient, ArchivematicaClientError,
+                      FedoraClient, FedoraClientError)
+from .management.commands.run_pipeline import Command as RunPipelineCommand
+from .models import MimeType, Package, PackageFile
 from .routines import (AddDataRoutine, CleanupRequester, DeliverRoutine,
-                       DownloadRoutine, ParseMETSRoutine, StoreRoutine)
+                       DownloadRoutine, FetchRoutine, ParseMETSRoutine,
+                       ReapRoutine, RoutineError, StoreRoutine)
 from .views import PackageViewSet
+from .workspace import WorkspaceError, WorkspaceManager
 
 
 class PackageRoutinesTestCase(TestCase):
@@ -61,35 +77,117 @@ class PackageRoutinesTestCase(TestCase):
                 package.archivesspace_uri = 'repositories/2/archival_objects/1'
             package.save()
 
+    def test_package_mimetypes(self):
+        """Ensures mimetypes are stored as package files and only loaded when read."""
+        self.create_packages_with_status(Package.METS_PARSED, package_type='dip')
+        self.assertEqual(MimeType.objects.count(), 6)
+        self.assertEqual(PackageFile.objects.count(), 14 * len(self.dip_uuids))
+        package = Package.objects.get(archivematica_identifier=self.dip_uuids[0])
+        with self.assertNumQueries(1):
+            self.assertEqual(package.mimetypes['18357d28-5f69-471e-8ef1-c706a8026e01'], 'application/pdf')
+            self.assertEqual(len(package.mimetypes), 14)
+        package.mimetypes = {'18357d28-5f69-471e-8ef1-c706a8026e01': 'text/plain'}
+        package.save()
+        self.assertEqual(Package.objects.get(pk=package.pk).mimetypes, {'18357d28-5f69-471e-8ef1-c706a8026e01': 'text/plain'})
+
     def copy_binaries(self, filter):
+        """Copies fixture packages into their workspaces, as DownloadRoutine would."""
         for f in listdir(join('fixtures', 'binaries')):
             if f.endswith(filter):
-                copyfile(join('fixtures', 'binaries', f), join(settings.TMP_DIR, f))
+                workspace = join(settings.TMP_DIR, splitext(f)[0])
+                makedirs(workspace, exist_ok=True)
+                copyfile(join('fixtures', 'binaries', f), join(workspace, f))
 
-    @patch('amclient.AMClient.get_package_details')
+    @patch('storer.clients.ArchivematicaClient.get_packages_details')
     def test_add_data_routine(self, mock_details):
         """Tests that AddDataRoutine works as expected."""
-        mock_details.return_value = {
+        mock_details.side_effect = lambda uuids: {uuid: {
+            "uuid": uuid,
             "package_type": "AIP",
             "resource_uri": "/api/v2/file/70588e68-7742-49aa-a0ef-774a46b17b0a/",
-            "current_location": "/api/v2/location/7662e69a-6b4f-4a83-825f-ce3b92006969/"}
+            "current_location": "/api/v2/location/7662e69a-6b4f-4a83-825f-ce3b92006969/"} for uuid in uuids}
         self.create_packages_with_status(Package.CREATED)
-        for _ in range(len(self.aip_uuids)):
-            msg, count = AddDataRoutine().run()
-            self.assertNotEqual(False, msg, "Data not added to packages correctly.")
-            self.assertEqual("Data added to package.", msg)
+        # Includes checking the leases are still held before saving, in a savepoint.
+        with self.assertNumQueries(9):
+            msg, identifiers = AddDataRoutine().run()
+        self.assertEqual("Data added to package.", msg)
+        self.assertEqual(identifiers, self.aip_uuids)
+        self.assertEqual(mock_details.call_count, 1)
         for package in Package.objects.all():
             self.assertEqual(package.process_status, Package.DATA_ADDED)
             self.assertEqual(package.type, 'aip')
             self.assertEqual(package.fedora_uri, '/api/v2/file/70588e68-7742-49aa-a0ef-774a46b17b0a/')
             self.assertTrue(isinstance(package.data, dict))
 
+    @patch('storer.clients.ArchivematicaClient.get_package_details')
+    @patch('storer.clients.ArchivematicaClient.get_packages_details')
+    def test_add_data_backoff(self, mock_bulk_details, mock_details):
+        """Ensures packages which fail are set aside until their backoff has elapsed."""
+        mock_bulk_details.side_effect = ArchivematicaClientError("List endpoint not supported")
+        mock_details.side_effect = ArchivematicaClientError("Package not found")
+        self.create_packages_with_status(Package.CREATED)
+        with self.assertRaises(Exception) as context:
+            AddDataRoutine().run()
+        self.assertEqual(context.exception.args[1], self.aip_uuids)
+        self.assertEqual(mock_details.call_count, len(self.aip_uuids))
+        for package in Package.objects.all():
+            self.assertEqual(package.process_status, Package.CREATED)
+            self.assertEqual(package.attempts, 1)
+            self.assertGreater(package.next_attempt_at, timezone.now())
+        msg, identifiers = AddDataRoutine().run()
+        self.assertEqual(mock_details.call_count, len(self.aip_uuids))
+        self.assertEqual(msg, "No packages waiting for data to be added.")
+
+    @patch('storer.resilience.time.sleep')
+    def test_circuit_breaker(self, mock_sleep):
+        """Ensures transient errors are retried and a failing endpoint is no longer called."""
+        mock_call = MagicMock(side_effect=requests.ConnectionError)
+        url = 'http://archivematica.example/api/v2/file/'
+        self.addCleanup(resilience._breakers.clear)
+        with patch.dict(settings.CIRCUIT_BREAKER, {'failure_threshold': 3}):
+            with self.assertRaises(requests.ConnectionError):
+                resilience.call(url, mock_call, retries=1)
+            self.assertEqual(mock_call.call_count, 2)
+            self.assertEqual(mock_sleep.call_count, 1)
+            with self.assertRaises(resilience.CircuitOpenError):
+                resilience.call(url, mock_call, retries=1)
+            self.assertEqual(mock_call.call_count, 3)
+            with self.assertRaises(resilience.CircuitOpenError):
+                resilience.call(url, mock_call)
+            self.assertEqual(mock_call.call_count, 3)
+            breaker = resilience.get_breaker(url)
+            breaker.opened_at -= breaker.reset_timeout
+            mock_call.side_effect = ValueError
+            with self.assertRaises(ValueError):
+                resilience.call(url, mock_call)
+            self.assertEqual(breaker.failures, 3)
+            mock_call.side_effect = None
+            resilience.call(url, mock_call)
+            self.assertEqual(breaker.failures, 0)
+
+    @patch('storer.resilience.time.sleep')
+    @patch('pyfc4.models.API.http_request')
+    def test_fedora_server_error(self, mock_request, mock_sleep):
+        """Ensures server errors reported by pyfc4 are retried and open Fedora's circuit breaker."""
+        self.addCleanup(resilience._breakers.clear)
+        mock_request.return_value = MagicMock(status_code=503)
+        client = FedoraClient(settings.FEDORA['baseurl'], settings.FEDORA['username'], settings.FEDORA['password'])
+        with patch.dict(settings.CIRCUIT_BREAKER, {'failure_threshold': 4}), patch.object(settings, 'RETRY_ATTEMPTS', 1):
+            for _ in range(3):
+                with self.assertRaises(FedoraClientError):
+                    client.create_container()
+            self.assertEqual(mock_request.call_count, 4)
+            breaker = resilience.get_breaker(settings.FEDORA['baseurl'])
+            self.assertIsNotNone(breaker.opened_at)
+            with self.assertRaises(resilience.CircuitOpenError):
+                client.retrieve("http://fedora/rest/uuid")
+
     def test_add_data_get_end_status(self):
         """Ensures end status is set as expected in AddDataRoutine."""
         for location, expected_status in [
             ('/api/v2/location/7662e69a-6b4f-4a83-825f-ce3b92006968/', Package.DOWNLOADED),
                 ('/api/v2/location/7662e69a-6b4f-4a83-825f-ce3b92006969/', Package.DATA_ADDED)]:
-            package = Package.objects.create(
+            package = Package(
                 archivematica_identifier='b663b040-5718-427c-ac84-26fc48191072',
                 process_status=Package.CREATED,
                 data={'current_location': location}
@@ -97,26 +195,314 @@ class PackageRoutinesTestCase(TestCase):
             end_status = AddDataRoutine().get_end_status(package)
             self.assertEqual(end_status, expected_status)
 
-    @patch('amclient.AMClient.download_package')
+    @patch('storer.clients.ArchivematicaClient.download_package')
     def test_download_routine(self, mock_download):
         """Ensures DownloadRoutine downloads files and sets status."""
-        download_path = join(settings.TMP_DIR, '4d8fae2e-e840-444a-ab40-9f9a74a60522.tar')
-        mock_download.return_value = download_path
+        mock_download.side_effect = lambda uuid, dest, **kwargs: copyfile(
+            join('fixtures', 'binaries', '4d8fae2e-e840-444a-ab40-9f9a74a60522.tar'), dest)
         self.create_packages_with_status(Package.DATA_ADDED)
         for _ in range(len(self.aip_uuids)):
-            copyfile(join('fixtures', 'binaries', '4d8fae2e-e840-444a-ab40-9f9a74a60522.tar'), download_path)
             msg, count = DownloadRoutine().run()
             self.assertNotEqual(False, msg, "Packages not downloaded correctly")
             self.assertEqual("Package downloaded.", msg)
         self.assertEqual(len(listdir(settings.TMP_DIR)), len(self.aip_uuids), "Wrong number of packages downloaded")
         self.assertEqual(len(Package.objects.filter(process_status=Package.DOWNLOADED)), len(self.aip_uuids))
 
+    def mock_response(self, status_code, headers, body=b"", error=None):
+        """Returns a mock streaming response which raises `error` after the body."""
+        response = MagicMock(status_code=status_code, headers=headers)
+        response.__enter__.return_value = response
+
+        def iter_content(chunk_size):
+            yield body
+            if error:
+                raise error
+        response.iter_content.side_effect = iter_content
+        return response
+
+    @patch('storer.workspace.WorkspaceManager.free_space')
+    def test_download_admission(self, mock_free_space):
+        """Ensures packages are only claimed for download if there is disk space for them."""
+        self.create_packages_with_status(Package.DATA_ADDED)
+        large, small = self.aip_uuids
+        package = Package.objects.get(archivematica_identifier=large)
+        package.data['size'] = 10000000
+        package.save()
+        mock_free_space.return_value = 1000000
+        with patch.dict(settings.DISK_ADMISSION, {'headroom': 0}):
+            claimed = DownloadRoutine().claim_packages(2)
+            self.assertEqual([p.archivematica_identifier for p in claimed], [small])
+            mock_free_space.return_value = 1000000 + 446866
+            self.assertEqual(DownloadRoutine().claim_packages(2), [])
+            mock_free_space.return_value = 10000000 + 446866
+            claimed = DownloadRoutine().claim_packages(2)
+            self.assertEqual([p.archivematica_identifier for p in claimed], [large])
+            self.assertIsNone(cache.get(f"disk-wait-{large}"))
+        dip = Package(type='dip', data={'size': 100})
+        self.assertEqual(DownloadRoutine().required_space(dip), 200)
+        with patch.dict(settings.FEDORA, {'stream_dips': True}):
+            self.assertEqual(DownloadRoutine().required_space(dip), 100)
+
+    @patch('storer.workspace.WorkspaceManager.free_space')
+    def test_download_admission_aging(self, mock_free_space):
+        """Ensures a package which waited too long for space is not overtaken, and partial files are credited."""
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.create_packages_with_status(Package.DATA_ADDED)
+        large, small = self.aip_uuids
+        package = Package.objects.get(archivematica_identifier=large)
+        package.data['size'] = 10000000
+        package.save()
+        mock_free_space.return_value = 1000000
+        with patch.dict(settings.DISK_ADMISSION, {'headroom': 0, 'max_wait': 0}):
+            self.assertEqual(DownloadRoutine().claim_packages(2), [])
+            with open(join(DownloadRoutine().workspaces.create(large), f"{large}.7z"), "wb") as f:
+                f.truncate(9000000)
+            claimed = DownloadRoutine().claim_packages(1)
+            self.assertEqual([p.archivematica_identifier for p in claimed], [large])
+        with patch.dict(settings.DISK_ADMISSION, {'headroom': 0}), patch('storer.workspace.WorkspaceManager.total_space', return_value=100):
+            self.assertEqual(DownloadRoutine().claim_packages(1), [])
+
+    @patch('storer.routines.ParseMETSRoutine.parse_mets')
+    @patch('storer.routines.ParseMETSRoutine.get_remote_mets')
+    @patch('storer.clients.ArchivematicaClient.download_package')
+    def test_fetch_routine(self, mock_download, mock_remote_mets, mock_parse):
+        """Ensures AIPs are downloaded while their METS is parsed, and partial results are kept for either routine to finish."""
+        mock_download.side_effect = lambda uuid, dest, **kwargs: copyfile(join('fixtures', 'binaries', f"{uuid}.7z"), dest)
+        mock_parse.return_value = {
+            "internal_sender_identifier": '12345',
+            "archivesspace_uri": 'repositories/2/archival_objects/1',
+            "origin": 'aurora',
+            "mimetypes": {"foo": "bar"}, }
+        self.create_packages_with_status(Package.DATA_ADDED)
+        first, second = self.aip_uuids
+        msg, identifiers = FetchRoutine().run()
+        self.assertEqual(msg, "Package downloaded and METS data parsed.")
+        package = Package.objects.get(archivematica_identifier=first)
+        self.assertEqual(package.process_status, Package.METS_PARSED)
+        self.assertEqual(package.internal_sender_identifier, '12345')
+        self.assertEqual(package.mimetypes, {"foo": "bar"})
+        self.assertTrue(isfile(join(settings.TMP_DIR, first, f"{first}.7z")))
+
+        mock_download.side_effect = ArchivematicaClientError("Connection reset")
+        with self.assertRaises(Exception):
+            FetchRoutine().run()
+        package = Package.objects.get(archivematica_identifier=second)
+        self.assertEqual(package.process_status, Package.METS_FETCHED)
+        self.assertEqual(package.internal_sender_identifier, '12345')
+        self.assertEqual(mock_remote_mets.call_count, 2)
+
+        Package.objects.update(next_attempt_at=None)
+        mock_download.side_effect = lambda uuid, dest, **kwargs: copyfile(join('fixtures', 'binaries', f"{uuid}.7z"), dest)
+        msg, identifiers = DownloadRoutine().run()
+        self.assertEqual(identifiers, [second])
+        self.assertEqual(mock_remote_mets.call_count, 2)
+        self.assertEqual(Package.objects.get(archivematica_identifier=second).process_status, Package.METS_PARSED)
+
+        Package.objects.filter(archivematica_identifier=first).update(process_status=Package.DATA_ADDED)
+        mock_parse.side_effect = RoutineError("No BagIt metadata found")
+        with self.assertRaises(Exception):
+            FetchRoutine().run()
+        self.assertEqual(Package.objects.get(archivematica_identifier=first).process_status, Package.DOWNLOADED)
+
+    def test_download_package_resume(self):
+        """Ensures interrupted downloads are resumed from the last byte written."""
+        content = b"0123456789"
+        mock_response = self.mock_response
+        client = ArchivematicaClient("http://archivematica", "user", "key")
+        client.session.get = MagicMock(side_effect=[
+            mock_response(200, {"Content-Length": "10"}, content[:4], requests.ConnectionError()),
+            mock_response(206, {"Content-Range": "bytes 4-9/10"}, content[4:])])
+        dest = join(settings.TMP_DIR, "package.7z")
+        self.assertEqual(client.download_package("uuid", dest), len(content))
+        with open(dest, "rb") as f:
+            self.assertEqual(f.read(), content)
+        self.assertEqual(client.session.get.call_args[1]["headers"], {"Range": "bytes=4-"})
+
+    def test_download_package_ranges(self):
+        """Ensures packages are downloaded in byte ranges when the server accepts them."""
+        content = b"0123456789"
+
+        def ranged_response(url, headers, **kwargs):
+            start, end = [int(i) for i in headers["Range"][6:].split("-")]
+            return self.mock_response(206, {}, content[start:end + 1])
+
+        client = ArchivematicaClient("http://archivematica", "user", "key")
+        client.session.head = MagicMock(return_value=MagicMock(headers={"Accept-Ranges": "bytes"}))
+        client.session.get = MagicMock(side_effect=ranged_response)
+        dest = join(settings.TMP_DIR, "package.7z")
+        self.assertEqual(client.download_package_ranges("uuid", dest, len(content), 3), len(content))
+        with open(dest, "rb") as f:
+            self.assertEqual(f.read(), content)
+        self.assertEqual(client.session.get.call_count, 3)
+
+        client.session.head = MagicMock(return_value=MagicMock(headers={}))
+        client.session.get = MagicMock(return_value=self.mock_response(200, {"Content-Length": "10"}, content))
+        self.assertEqual(client.download_package_ranges("uuid", dest, len(content), 3), len(content))
+        self.assertEqual(client.session.get.call_count, 1)
+
+    def test_download_package_ranges_length(self):
+        """Ensures ranged downloads fail if the server's length differs from the expected size."""
+        content = b"0123456789"
+        client = ArchivematicaClient("http://archivematica", "user", "key")
+        dest = join(settings.TMP_DIR, "package.7z")
+        client.session.head = MagicMock(return_value=MagicMock(headers={"Accept-Ranges": "bytes", "Content-Length": "10"}))
+        client.session.get = MagicMock()
+        with self.assertRaises(ArchivematicaClientError):
+            client.download_package_ranges("uuid", dest, 8, 2)
+        self.assertEqual(client.session.get.call_count, 0)
+
+        def ranged_response(url, headers, **kwargs):
+            start, end = [int(i) for i in headers["Range"][6:].split("-")]
+            return self.mock_response(206, {"Content-Range": f"bytes {start}-{end}/10"}, content[start:end + 1])
+
+        client.session.head = MagicMock(return_value=MagicMock(headers={"Accept-Ranges": "bytes"}))
+        client.session.get = MagicMock(side_effect=ranged_response)
+        with self.assertRaises(ArchivematicaClientError):
+            client.download_package_ranges("uuid", dest, 8, 2)
+
+        client.session.head = MagicMock(return_value=MagicMock(headers={}))
+        client.session.get = MagicMock(return_value=self.mock_response(200, {"Content-Length": "10"}, content))
+        with self.assertRaises(ArchivematicaClientError):
+            client.download_package_ranges("uuid", dest, 8, 2)
+
+    def test_fedora_create_binary(self):
+        """Ensures binaries are streamed to Fedora and described in one update."""
+        client = FedoraClient(settings.FEDORA['baseurl'], settings.FEDORA['username'], settings.FEDORA['password'], chunk_size=1024)
+        client.session = MagicMock()
+        uploaded = []
+        client.session.put.side_effect = lambda uri, data, headers: uploaded.append(b"".join(data)) or MagicMock()
+        container = MagicMock()
+        container.uri_as_string.return_value = "http://fedora/rest/uuid"
+        self.copy_binaries(filter='.tar')
+        filename = "4d8fae2e-e840-444a-ab40-9f9a74a60522.tar"
+        path = join(settings.TMP_DIR, splitext(filename)[0], filename)
+        uri = client.create_binary(path, container, "application/x-tar")
+        self.assertEqual(uri, f"http://fedora/rest/uuid/files/{filename}")
+        put_args = client.session.put.call_args
+        self.assertEqual(put_args[0][0], uri)
+        self.assertEqual(put_args[1]["headers"]["Content-Type"], "application/x-tar")
+        with open(path, "rb") as f:
+            self.assertEqual(uploaded, [f.read()])
+        patch_args = client.session.patch.call_args
+        self.assertEqual(patch_args[0][0], f"{uri}/fcr:metadata")
+        self.assertIn(f'rdfs:label "{filename}"', patch_args[1]["data"])
+        self.assertIn('dc:format "application/x-tar"', patch_args[1]["data"])
+
+    def test_reap_routine(self):
+        """Ensures packages with expired leases are returned to their start status and partial files are removed."""
+        self.create_packages_with_status(Package.DOWNLOADING)
+        expired, leased = self.aip_uuids
+        entered = timezone.now() - timedelta(days=1)
+        Package.objects.filter(archivematica_identifier=expired).update(
+            lease_expires_at=timezone.now() - timedelta(seconds=1), status_changed_at=entered)
+        Package.objects.filter(archivematica_identifier=leased).update(lease_expires_at=timezone.now() + timedelta(seconds=60))
+        self.copy_binaries(filter='.7z')
+        msg, identifiers = DownloadRoutine().run()
+        self.assertEqual(msg, "Service currently running")
+        with patch.dict(settings.ROUTINE_CONCURRENCY, {'download': 2}):
+            msg, identifiers = DownloadRoutine().run()
+            self.assertEqual(msg, "No packages waiting to be downloaded.")
+        msg, identifiers = ReapRoutine().run()
+        self.assertEqual(identifiers, [expired])
+        package = Package.objects.get(archivematica_identifier=expired)
+        self.assertEqual(package.process_status, Package.DATA_ADDED)
+        self.assertEqual(package.attempts, 1)
+        self.assertIsNone(package.lease_expires_at)
+        self.assertEqual(package.status_changed_at, entered)
+        self.assertFalse(isdir(join(settings.TMP_DIR, expired)))
+        self.assertEqual(Package.objects.get(archivematica_identifier=leased).process_status, Package.DOWNLOADING)
+        self.assertTrue(isfile(join(settings.TMP_DIR, leased, f"{leased}.7z")))
+        msg, identifiers = ReapRoutine().run()
+        self.assertEqual(msg, "No packages with expired leases.")
+        Package.objects.filter(archivematica_identifier=leased).update(
+            process_status=Package.FETCHING, internal_sender_identifier='12345', lease_expires_at=timezone.now() - timedelta(seconds=1))
+        msg, identifiers = ReapRoutine().run()
+        self.assertEqual(Package.objects.get(archivematica_identifier=leased).process_status, Package.METS_FETCHED)
+
+    def test_workspace_manager(self):
+        """Ensures package files are kept in per-package workspaces which are removed as a unit."""
+        workspaces = WorkspaceManager(settings.TMP_DIR)
+        uuid = self.aip_uuids[0]
+        self.copy_binaries(filter='.7z')
+        size = getsize(workspaces.path(uuid, f"{uuid}.7z"))
+        self.assertEqual(workspaces.usage(uuid), size)
+        self.assertEqual(sorted(workspaces.workspaces()), sorted(self.aip_uuids))
+        makedirs(workspaces.path(uuid, "extracted"))
+        workspaces.discard(uuid, "extracted", "missing.xml")
+        self.assertEqual(listdir(workspaces.path(uuid)), [f"{uuid}.7z"])
+        workspaces.remove(uuid)
+        self.assertEqual(workspaces.workspaces(), [self.aip_uuids[1]])
+        for invalid in ["", "..", "../etc"]:
+            with self.assertRaises(WorkspaceError):
+                workspaces.path(invalid)
+        with self.assertRaises(WorkspaceError):
+            WorkspaceManager(join(settings.TMP_DIR, "missing"))
+
+    @patch('storer.clients.ArchivematicaClient.download_package')
+    def test_routine_lost_lease(self, mock_download):
+        """Ensures a worker which lost its lease does not overwrite the package."""
+        self.create_packages_with_status(Package.DATA_ADDED)
+        uuid = self.aip_uuids[0]
+        reclaimed = timezone.now() + timedelta(seconds=600)
+
+        def reap_and_reclaim(uuid, dest, **kwargs):
+            Package.objects.filter(archivematica_identifier=uuid).update(lease_expires_at=reclaimed)
+        mock_download.side_effect = reap_and_reclaim
+        with self.assertRaises(Exception) as cm:
+            DownloadRoutine().run()
+        self.assertEqual(cm.exception.args, ("Lease expired while the package was being handled", uuid))
+        package = Package.objects.get(archivematica_identifier=uuid)
+        self.assertEqual(package.process_status, Package.DOWNLOADING)
+        self.assertEqual(package.lease_expires_at, reclaimed)
+
+        routine = DownloadRoutine()
+        with patch.dict(settings.ROUTINE_CONCURRENCY, {'download': 2}):
+            packages = routine.claim_packages(2)
+        self.assertEqual(len(packages), 1)
+        Package.objects.filter(pk=packages[0].pk).update(lease_expires_at=None)
+        routine.extend_leases(packages)
+        self.assertEqual(routine.held, set())
+
+    def test_workspace_legacy_files(self):
+        """Ensures files kept directly in the tmp directory by earlier versions are moved into workspaces."""
+        uuid = self.aip_uuids[0]
+        for name in [f"{uuid}.7z", f"METS.{uuid}.xml", "unrelated.7z"]:
+            open(join(settings.TMP_DIR, name), "wb").close()
+        workspaces = WorkspaceManager(settings.TMP_DIR)
+        workspaces.adopt_legacy_files()
+        self.assertEqual(sorted(listdir(settings.TMP_DIR)), [uuid, "unrelated.7z"])
+        self.assertEqual(sorted(listdir(workspaces.path(uuid))), [f"METS.{uuid}.xml", f"{uuid}.7z"])
+
+    def test_routine_claim_packages(self):
+        """Ensures routines claim the oldest packages, up to their concurrency limit."""
+        self.create_packages_with_status(Package.DATA_ADDED)
+        Package.objects.filter(archivematica_identifier=self.aip_uuids[0]).update(created=timezone.now())
+        claimed = DownloadRoutine().claim_packages(1)
+        self.assertEqual(len(claimed), 1)
+        self.assertEqual(claimed[0].archivematica_identifier, self.aip_uuids[1])
+        self.assertEqual(claimed[0].process_status, Package.DOWNLOADING)
+        self.assertEqual(len(Package.objects.filter(process_status=Package.DOWNLOADING)), 1)
+        msg, identifiers = DownloadRoutine().run()
+        self.assertEqual(msg, "Service currently running")
+        self.assertEqual(identifiers, None)
+
+    @patch('storer.helpers.send_post_request')
+    def test_routine_deferred_fields(self, mock_post):
+        """Ensures routines only load and save the fields they declare."""
+        self.create_packages_with_status(Package.METS_PARSED)
+        package = StoreRoutine().claim_packages(1)[0]
+        self.assertIn('internal_sender_identifier', package.get_deferred_fields())
+        Package.objects.update(process_status=Package.STORED)
+        with self.assertNumQueries(2):
+            DeliverRoutine().run()
+
     def test_download_routine_is_downloadable(self):
         """Ensures is_downloadable correctly parses package data."""
         for pipeline, expected_status in [
                 ('/api/v2/pipeline/b80b39f0-ab3d-406d-8efd-dd48b532c34f/', True),
                 ('/api/v2/pipeline/b80b39f0-ab3d-406d-8efd-dd48b532c34g/', False)]:
-            package = Package.objects.create(
+            package = Package(
                 archivematica_identifier='b663b040-5718-427c-ac84-26fc48191072',
                 process_status=Package.DATA_ADDED,
                 data={'origin_pipeline': pipeline}
@@ -151,6 +537,43 @@ class PackageRoutinesTestCase(TestCase):
         self.assertEqual(mock_parse.call_count, len(self.aip_uuids))
         # assert cleanup?
 
+    @patch('storer.routines.ParseMETSRoutine.parse_mets')
+    @patch('storer.clients.ArchivematicaClient.extract_file')
+    def test_parse_routine_mets_source(self, mock_extract, mock_parse):
+        """Ensures METS files of downloaded AIPs are read from the source chosen by the policy."""
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.copy_binaries(filter='.7z')
+        mock_parse.return_value = {
+            "internal_sender_identifier": '12345',
+            "archivesspace_uri": 'repositories/2/archival_objects/1',
+            "origin": 'aurora',
+            "mimetypes": {"foo": "bar"}, }
+        self.create_packages_with_status(Package.DOWNLOADED)
+        first, second = self.aip_uuids
+        with patch.dict(settings.METS_SOURCE, {'policy': 'remote'}):
+            msg, identifiers = ParseMETSRoutine().run()
+        self.assertEqual(identifiers, [first])
+        self.assertEqual(mock_extract.call_count, 1)
+        self.assertTrue(isfile(join(settings.TMP_DIR, first, f"{first}.7z")))
+        self.assertEqual(Package.objects.get(archivematica_identifier=first).process_status, Package.METS_PARSED)
+        with patch.dict(settings.METS_SOURCE, {'policy': 'auto'}):
+            msg, identifiers = ParseMETSRoutine().run()
+            self.assertEqual(identifiers, [second])
+            self.assertEqual(mock_extract.call_count, 1)
+            self.assertIsNotNone(cache.get('mets-cost-local'))
+            package = Package.objects.get(archivematica_identifier=second)
+            with helpers.open_7z(join(settings.TMP_DIR, second, f"{second}.7z")) as archive:
+                cache.set('mets-cost-remote', 0)
+                self.assertTrue(ParseMETSRoutine().use_remote_mets(package, archive))
+                cache.set('mets-cost-remote', 10 ** 6)
+                self.assertFalse(ParseMETSRoutine().use_remote_mets(package, archive))
+            with patch('storer.helpers.py7zr.SevenZipFile', wraps=py7zr.SevenZipFile) as mock_open:
+                ParseMETSRoutine().get_aip_mets(package)
+            self.assertEqual(mock_open.call_count, 1)
+        with patch.dict(settings.METS_SOURCE, {'policy': 'local'}), helpers.open_7z(join(settings.TMP_DIR, second, f"{second}.7z")) as archive:
+            self.assertFalse(ParseMETSRoutine().use_remote_mets(package, archive))
+
     @patch('storer.routines.ParseMETSRoutine.parse_mets')
     def test_parse_routine_dip(self, mock_parse):
         """Ensures DIPs are correctly parsed."""
@@ -179,7 +602,7 @@ class PackageRoutinesTestCase(TestCase):
         # assert cleanup?
 
     @patch('storer.routines.ParseMETSRoutine.parse_mets')
-    @patch('amclient.AMClient.extract_file')
+    @patch('storer.clients.ArchivematicaClient.extract_file')
     def test_parse_routine_remote(self, mock_extract, mock_parse):
         """Ensures remote packages are correctly parsed."""
         self.copy_binaries(filter='.7z')
@@ -210,6 +633,37 @@ class PackageRoutinesTestCase(TestCase):
         self.assertEqual(mock_extract.call_count, len(self.aip_uuids))
         # assert cleanup?
 
+    @patch('storer.resilience.time.sleep')
+    @patch('requests.Session.request')
+    def test_parse_routine_remote_error(self, mock_request, mock_sleep):
+        """Ensures failed remote METS requests are retried, count against the circuit breaker and are not recorded as a cost."""
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.addCleanup(resilience._breakers.clear)
+
+        def error_response(status_code):
+            response = requests.Response()
+            response.status_code = status_code
+            response.url = settings.ARCHIVEMATICA['baseurl']
+            response.raw = BytesIO()
+            return response
+
+        self.create_packages_with_status(Package.DOWNLOADED)
+        package = Package.objects.get(archivematica_identifier=self.aip_uuids[0])
+        mock_request.side_effect = lambda *args, **kwargs: error_response(500)
+        with patch.object(settings, 'RETRY_ATTEMPTS', 2):
+            with self.assertRaises(ArchivematicaClientError):
+                ParseMETSRoutine().get_remote_mets(package)
+        self.assertEqual(mock_request.call_count, 3)
+        self.assertEqual(resilience.get_breaker(settings.ARCHIVEMATICA['baseurl']).failures, 3)
+        self.assertEqual(mock_request.call_args[1]['params'], {'relative_path_to_file': f"data/METS.{self.aip_uuids[0]}.xml"})
+        mock_request.reset_mock()
+        mock_request.side_effect = lambda *args, **kwargs: error_response(404)
+        with self.assertRaises(ArchivematicaClientError):
+            ParseMETSRoutine().get_remote_mets(package)
+        self.assertEqual(mock_request.call_count, 1)
+        self.assertIsNone(cache.get('mets-cost-remote'))
+
     def test_parse_mets(self):
         """Ensures METS files are parsed correctly."""
         for mets_file, expected in [
@@ -244,12 +698,63 @@ class PackageRoutinesTestCase(TestCase):
             output = ParseMETSRoutine().parse_mets(join('fixtures', 'mets', mets_file))
             self.assertEqual(output, expected)
 
+    def synthetic_mets(self, file_count):
+        """Returns a METS file with BagIt metadata and `file_count` files in
+        its fileSec and structMap, but no PREMIS objects."""
+        files = "".join(
+            f'<mets:file ID="file-{i}"><mets:FLocat xlink:href="objects/{i}.txt" LOCTYPE="OTHER"/></mets:file>'
+            for i in range(file_count))
+        divs = "".join(f'<mets:div LABEL="{i}.txt"><mets:fptr FILEID="file-{i}"/></mets:div>' for i in range(file_count))
+        return BytesIO((
+            '<mets:mets xmlns:mets="http://www.loc.gov/METS/" xmlns:xlink="http://www.w3.org/1999/xlink">'
+            '<mets:amdSec><mets:sourceMD><mets:mdWrap MDTYPE="OTHER" OTHERMDTYPE="BagIt"><mets:xmlData>'
+            '<transfer_metadata><Internal-Sender-Identifier>12345</Internal-Sender-Identifier></transfer_metadata>'
+            '</mets:xmlData></mets:mdWrap></mets:sourceMD></mets:amdSec>'
+            f'<mets:fileSec><mets:fileGrp USE="original">{files}</mets:fileGrp></mets:fileSec>'
+            f'<mets:structMap><mets:div>{divs}</mets:div></mets:structMap>'
+            '</mets:mets>').encode())
+
+    def test_parse_mets_memory(self):
+        """Ensures memory used to parse METS files does not grow with the number of files."""
+        peaks = []
+        for file_count in [1000, 20000]:
+            mets_file = self.synthetic_mets(file_count)
+            tracemalloc.start()
+            output = ParseMETSRoutine().parse_mets(mets_file)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            self.assertEqual(output['internal_sender_identifier'], '12345')
+            self.assertEqual(output['mimetypes'], {})
+        self.assertLess(peaks[1], peaks[0] * 2)
+
+    def test_extract_7z_mets(self):
+        """Ensures METS files are extracted from open AIPs."""
+        self.copy_binaries(filter='.7z')
+        uuid = self.aip_uuids[0]
+        archive = join(settings.TMP_DIR, uuid, f"{uuid}.7z")
+        dest = join(settings.TMP_DIR, uuid, f"METS.{uuid}.xml")
+        with helpers.open_7z(archive) as z:
+            member, expected = helpers.locate_7z_member(z, f"METS.{uuid}.xml")
+            mets_path, decompressed = helpers.extract_7z_mets(z, uuid, dest)
+        self.assertEqual(mets_path, dest)
+        self.assertTrue(isfile(dest))
+        self.assertEqual(decompressed, expected)
+        self.assertGreater(decompressed, 0)
+        self.assertEqual(sorted(listdir(join(settings.TMP_DIR, uuid))), [f"METS.{uuid}.xml", f"{uuid}.7z"])
+
+    def test_open_tar_mets(self):
+        """Ensures METS files are read from DIPs without extracting them."""
+        with helpers.open_tar_mets(join('fixtures', 'binaries', '96c906b4-c8ec-4e82-abe6-e37db767f12f.tar')) as mets_file:
+            output = ParseMETSRoutine().parse_mets(mets_file)
+        self.assertEqual(output['internal_sender_identifier'], '0c800188-f990-4502-b9d3-36e7dfb83a1d')
+        self.assertEqual(listdir(settings.TMP_DIR), [])
+
     def test_parse_routine_get_end_status(self):
         """Ensures end_status is correctly determined from packages."""
         for location, expected_status in [
             ('/api/v2/location/7662e69a-6b4f-4a83-825f-ce3b92006968/', Package.STORED),
                 ('/api/v2/location/7662e69a-6b4f-4a83-825f-ce3b92006969/', Package.METS_PARSED)]:
-            package = Package.objects.create(
+            package = Package(
                 archivematica_identifier='b663b040-5718-427c-ac84-26fc48191072',
                 process_status=Package.CREATED,
                 data={'current_location': location}
@@ -277,6 +782,36 @@ class PackageRoutinesTestCase(TestCase):
         self.assertEqual(mock_container.call_count, len(self.aip_uuids))
         self.assertEqual(mock_binary.call_count, len(self.aip_uuids))
 
+    @patch('storer.clients.FedoraClient.get_digest')
+    @patch('storer.clients.FedoraClient.upload_stream')
+    @patch('storer.clients.ArchivematicaClient.stream_package')
+    @patch('storer.clients.FedoraClient.create_container')
+    def test_store_routine_aip_stream(self, mock_container, mock_stream, mock_upload, mock_digest):
+        """Ensures AIPs are streamed to Fedora without being downloaded, and their digests checked."""
+        repo = fcrepo.Repository(root=settings.FEDORA['baseurl'],
+                                 username=settings.FEDORA['username'],
+                                 password=settings.FEDORA['password'])
+        mock_container.return_value = pcdm.PCDMObject(repo=repo)
+        with open(join('fixtures', 'binaries', f"{self.aip_uuids[0]}.7z"), 'rb') as f:
+            content = f.read()
+        mock_stream.return_value.__enter__.side_effect = lambda: iter([content[:1000], content[1000:]])
+        mock_upload.side_effect = lambda chunks, filename, container, mimetype: b"".join(chunks) and f"/files/{filename}"
+        mock_digest.return_value = hashlib.sha1(content).hexdigest()
+        self.create_packages_with_status(Package.METS_PARSED)
+        Package.objects.update(data={**Package.objects.first().data, 'size': len(content)})
+        with patch.dict(settings.FEDORA, {'stream_aips': True}):
+            self.assertEqual(AddDataRoutine().get_end_status(Package.objects.first()), Package.DOWNLOADED)
+            msg, identifiers = StoreRoutine().run()
+            self.assertEqual("Package stored.", msg)
+            mock_digest.return_value = "0" * 40
+            with self.assertRaises(Exception) as cm:
+                StoreRoutine().run()
+            self.assertIn("Digest of binary", cm.exception.args[0])
+        self.assertEqual(mock_upload.call_args[0][1], f"{self.aip_uuids[1]}.7z")
+        self.assertEqual(Package.objects.get(archivematica_identifier=self.aip_uuids[0]).process_status, Package.STORED)
+        self.assertEqual(Package.objects.get(archivematica_identifier=self.aip_uuids[1]).process_status, Package.METS_PARSED)
+        self.assertEqual(listdir(settings.TMP_DIR), [])
+
     @patch('storer.clients.FedoraClient.create_container')
     @patch('storer.clients.FedoraClient.create_binary')
     def test_store_routine_dip(self, mock_binary, mock_container):
@@ -297,6 +832,49 @@ class PackageRoutinesTestCase(TestCase):
         self.assertEqual(mock_container.call_count, len(self.dip_uuids))
         self.assertEqual(mock_binary.call_count, 14)
 
+    @patch.dict(settings.FEDORA, {'stream_dips': True})
+    @patch('storer.clients.FedoraClient.create_container')
+    @patch('storer.clients.FedoraClient.upload_binary')
+    def test_store_routine_dip_stream(self, mock_binary, mock_container):
+        """Ensures DIPs are stored from the archive without being extracted."""
+        repo = fcrepo.Repository(root=settings.FEDORA['baseurl'],
+                                 username=settings.FEDORA['username'],
+                                 password=settings.FEDORA['password'])
+        mock_container.return_value = pcdm.PCDMObject(repo=repo)
+        self.copy_binaries(filter='.tar')
+        self.create_packages_with_status(Package.METS_PARSED, package_type='dip')
+        msg, count = StoreRoutine().run()
+        self.assertEqual("Package stored.", msg)
+        self.assertEqual(mock_binary.call_count, 7)
+        for call in mock_binary.call_args_list:
+            filename = call[0][1]
+            self.assertEqual(filename, basename(filename))
+            self.assertEqual(call[0][3], Package.objects.get(archivematica_identifier=self.dip_uuids[0]).mimetypes[filename[0:36]])
+        self.assertEqual(listdir(settings.TMP_DIR), ['4d8fae2e-e840-444a-ab40-9f9a74a60522'])
+
+    @patch('storer.clients.FedoraClient.create_container')
+    @patch('storer.clients.FedoraClient.create_binary')
+    def test_store_routine_dip_retry(self, mock_binary, mock_container):
+        """Ensures only DIP files which failed to upload are retried."""
+        repo = fcrepo.Repository(root=settings.FEDORA['baseurl'],
+                                 username=settings.FEDORA['username'],
+                                 password=settings.FEDORA['password'])
+        mock_container.return_value = pcdm.PCDMObject(repo=repo)
+        failed = []
+
+        def create_binary(filepath, container, mimetype):
+            if not failed:
+                failed.append(filepath)
+                raise Exception("Connection reset")
+        mock_binary.side_effect = create_binary
+        self.copy_binaries(filter='.tar')
+        self.create_packages_with_status(Package.METS_PARSED, package_type='dip')
+        msg, count = StoreRoutine().run()
+        self.assertEqual("Package stored.", msg)
+        self.assertEqual(len(Package.objects.filter(process_status=Package.STORED)), 1)
+        self.assertEqual(mock_binary.call_count, 8)
+        self.assertEqual([c[0][0] for c in mock_binary.call_args_list].count(failed[0]), 2)
+
     @patch('storer.helpers.send_post_request')
     def test_deliver_routine(self, mock_post):
         """Ensures packages are correctly stored."""
@@ -307,6 +885,25 @@ class PackageRoutinesTestCase(TestCase):
         self.assertEqual("All package data delivered.", msg)
         self.assertEqual(len(Package.objects.filter(process_status=Package.DELIVERED)), len(self.aip_uuids))
 
+    @patch('storer.helpers.send_post_request')
+    def test_deliver_routine_batches(self, mock_post):
+        """Ensures packages are delivered in batches and failed packages do not block others."""
+        def post(url, data, session):
+            identifiers = [d['identifier'] for d in data] if isinstance(data, list) else [data['identifier']]
+            if 'failed' in identifiers:
+                raise requests.HTTPError('400 Client Error')
+        mock_post.side_effect = post
+        self.create_packages_with_status(Package.STORED)
+        Package.objects.filter(archivematica_identifier=self.aip_uuids[0]).update(internal_sender_identifier='failed')
+        with patch.object(DeliverRoutine, 'list_payload', True):
+            with self.assertRaises(Exception) as context:
+                DeliverRoutine().run()
+        self.assertEqual(context.exception.args[1], 'failed')
+        self.assertIsInstance(mock_post.call_args_list[0][0][1], list)
+        self.assertEqual(mock_post.call_count, 1 + len(self.aip_uuids))
+        self.assertEqual(len(Package.objects.filter(process_status=Package.DELIVERED)), len(self.aip_uuids) - 1)
+        self.assertEqual(Package.objects.get(internal_sender_identifier='failed').process_status, Package.STORED)
+
     @patch('storer.helpers.send_post_request')
     def test_cleanup_routine(self, mock_post):
         """Ensures packages are correctly cleaned up."""
@@ -343,6 +940,10 @@ class PackageRoutineViewsTestCase(TestCase):
     def test_download_view(self, mock_routine):
         self.assert_routine_called(mock_routine, 'download-package')
 
+    @patch('storer.routines.FetchRoutine.run')
+    def test_fetch_view(self, mock_routine):
+        self.assert_routine_called(mock_routine, 'fetch-package')
+
     @patch('storer.routines.ParseMETSRoutine.run')
     def test_parse_view(self, mock_routine):
         self.assert_routine_called(mock_routine, 'parse-mets')
@@ -359,6 +960,51 @@ class PackageRoutineViewsTestCase(TestCase):
     def test_cleanup_request_view(self, mock_routine):
         self.assert_routine_called(mock_routine, 'request-cleanup')
 
+    @patch('storer.routines.CleanupRequester.run')
+    @patch('storer.routines.DeliverRoutine.run')
+    @patch('storer.routines.StoreRoutine.run')
+    @patch('storer.routines.ParseMETSRoutine.run')
+    @patch('storer.routines.DownloadRoutine.run')
+    @patch('storer.routines.AddDataRoutine.run')
+    @patch('storer.routines.ReapRoutine.run')
+    def test_run_pipeline_command(self, *mock_routines):
+        """Ensures a pipeline pass runs every routine."""
+        for mock_routine in mock_routines:
+            mock_routine.return_value = ("Idle message", None)
+        call_command('run_pipeline', once=True)
+        for mock_routine in mock_routines:
+            mock_routine.assert_called_once()
+
+    def test_run_pipeline_busy_on_failure(self):
+        """Ensures a pass in which claimed packages failed is not treated as idle."""
+        command = RunPipelineCommand(stdout=StringIO(), stderr=StringIO())
+        routine = MagicMock()
+        routine.run.side_effect = Exception("Error downloading data", ["uuid"])
+        self.assertTrue(command.run_pass([routine]))
+        routine.run.side_effect = Exception("Directory does not exist")
+        self.assertFalse(command.run_pass([routine]))
+
+    def test_run_pipeline_stages(self):
+        """Ensures a long-running stage does not hold up the other stages."""
+        command = RunPipelineCommand(stdout=StringIO(), stderr=StringIO())
+        other_ran = Event()
+        overlapped = []
+
+        class SlowRoutine(object):
+            def run(self):
+                overlapped.append(other_ran.wait(5))
+                command.stopping.set()
+                return ("Package stored.", ["uuid"])
+
+        class OtherRoutine(object):
+            def run(self):
+                other_ran.set()
+                return ("Nothing to do.", [])
+
+        command.routines = (SlowRoutine, OtherRoutine)
+        command.handle(min_interval=0.01, max_interval=0.01, once=False)
+        self.assertEqual(overlapped, [True])
+
     def tearDown(self):
         if isdir(settings.TMP_DIR):
             rmtree(settings.TMP_DIR)
@@ -375,6 +1021,76 @@ class PackageViewsTestCase(TestCase):
             request = self.factory.post(reverse('package-list'), data, format="json")
             response = PackageViewSet.as_view(actions={"post": "create"})(request)
             self.assertEqual(response.status_code, expected_status, "Wrong HTTP code")
+        # A concurrent request created the package after the existence check.
+        with patch('django.db.models.query.QuerySet.exists', return_value=False):
+            request = self.factory.post(reverse('package-list'), {"identifier": "12345"}, format="json")
+            response = PackageViewSet.as_view(actions={"post": "create"})(request)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("already exists", response.data["detail"])
+
+    def test_bulk_create_view(self):
+        """Ensures packages are created in bulk and duplicates are skipped."""
+        Package.objects.create(archivematica_identifier="12345", process_status=Package.CREATED)
+        view = PackageViewSet.as_view(actions={"post": "bulk"})
+        request = self.factory.post(reverse('package-bulk'), {"identifiers": "12345"}, format="json")
+        self.assertEqual(view(request).status_code, 400, "Wrong HTTP code")
+        request = self.factory.post(reverse('package-bulk'), {"identifiers": ["12345", "23456", "34567", "23456"]}, format="json")
+        # The insert is wrapped in a savepoint, which adds two queries.
+        with self.assertNumQueries(4):
+            response = view(request)
+        self.assertEqual(response.status_code, 201, "Wrong HTTP code")
+        self.assertEqual(response.data["count"], 2)
+        self.assertEqual(response.data["duplicates"], 2)
+        self.assertEqual(
+            sorted(Package.objects.values_list('archivematica_identifier', flat=True)),
+            ["12345", "23456", "34567"])
+        # A concurrent request created a package after the existence check.
+        request = self.factory.post(reverse('package-bulk'), {"identifiers": ["34567", "45678"]}, format="json")
+        with patch('django.db.models.query.QuerySet.values_list', return_value=[]):
+            response = view(request)
+        self.assertEqual(response.data["count"], 1)
+        self.assertEqual(response.data["duplicates"], 1)
+        self.assertEqual(Package.objects.filter(archivematica_identifier="45678").count(), 1)
+
+    def test_list_view(self):
+        """Ensures packages are filtered and paginated, and only requested fields are returned."""
+        for identifier, process_status in [("12345", Package.CREATED), ("23456", Package.STORED), ("34567", Package.STORED)]:
+            Package.objects.create(archivematica_identifier=identifier, process_status=process_status, type='aip')
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('package-list'), {"process_status": Package.STORED, "fields": "archivesspace_uri,process_status,url"})
+        self.assertEqual(response.status_code, 200, "Wrong HTTP code")
+        self.assertNotIn("count", response.data)
+        self.assertEqual(len(response.data["results"]), 2)
+        for result in response.data["results"]:
+            self.assertEqual(set(result), {"archivesspace_uri", "process_status", "url"})
+            self.assertEqual(result["process_status"], Package.STORED)
+        with patch('storer.views.PackageCursorPagination.page_size', 1):
+            response = self.client.get(reverse('package-list'), {"type": "aip,dip"})
+            self.assertEqual(len(response.data["results"]), 1)
+            self.assertEqual(response.data["results"][0]["archivematica_identifier"], "34567")
+            response = self.client.get(response.data["next"])
+            self.assertEqual(response.data["results"][0]["archivematica_identifier"], "23456")
+        response = self.client.get(reverse('package-list'), {"process_status": "stored"})
+        self.assertEqual(response.status_code, 400, "Wrong HTTP code")
+
+    def test_pipeline_status_view(self):
+        """Ensures package counts are aggregated per status and cached."""
+        self.addCleanup(cache.clear)
+        for identifier, process_status in [
+                ("12345", Package.CREATED), ("23456", Package.STORED), ("34567", Package.STORED), ("45678", Package.CLEANED_UP)]:
+            Package.objects.create(archivematica_identifier=identifier, process_status=process_status)
+        Package.objects.filter(archivematica_identifier="34567").update(status_changed_at=timezone.now() - timedelta(days=2))
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('pipeline-status'))
+        self.assertEqual(response.status_code, 200, "Wrong HTTP code")
+        self.assertEqual(response.data["total"], 4)
+        self.assertEqual(response.data["completed_within"], {"hour": 1, "day": 1})
+        stored = [s for s in response.data["statuses"] if s["process_status"] == Package.STORED][0]
+        self.assertEqual(stored["count"], 2)
+        self.assertEqual(stored["entered_within"], {"hour": 1, "day": 1})
+        self.assertGreater(stored["oldest_age"], 2 * 24 * 60 * 60)
+        with self.assertNumQueries(0):
+            self.client.get(reverse('pipeline-status'))
 
     def test_health_check(self):
         status = self.client.get(reverse('ping'))
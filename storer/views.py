@@ -1,12 +1,31 @@
+from datetime import timedelta
+
 from asterism.views import RoutineView, prepare_response
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Min, Q
+from django.utils import timezone
 from rest_framework import status
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import CursorPagination
 from rest_framework.response import Response
+from rest_framework.views import APIView
 from rest_framework.viewsets import ModelViewSet
 
+from gemini import settings
 from storer.models import Package
 from storer.routines import (AddDataRoutine, CleanupRequester, DeliverRoutine,
-                             DownloadRoutine, ParseMETSRoutine, StoreRoutine)
-from storer.serializers import PackageListSerializer, PackageSerializer
+                             DownloadRoutine, FetchRoutine, ParseMETSRoutine,
+                             ReapRoutine, StoreRoutine)
+from storer.serializers import (PackageListSerializer, PackageSerializer,
+                                get_requested_fields)
+
+
+class PackageCursorPagination(CursorPagination):
+    """Paginates packages by position rather than page number, which avoids
+    counting all matching packages for every page."""
+    ordering = ('-last_modified', '-id')
 
 
 class PackageViewSet(ModelViewSet):
@@ -14,20 +33,55 @@ class PackageViewSet(ModelViewSet):
     Endpoint for packages.
 
     list:
-    Returns a list of packages.
+    Returns a list of packages, most recently modified first. Packages can be
+    filtered by `process_status`, `type` and `origin`, each of which accepts
+    a comma-separated list of values.
 
     retrieve:
     Returns a single package, identified by a primary key.
+
+    bulk:
+    Creates packages for a list of identifiers.
+
+    The `fields` parameter limits the returned fields to a comma-separated
+    list of field names.
     """
     model = Package
     serializer_class = PackageSerializer
-    queryset = Package.objects.all().order_by('-last_modified')
+    queryset = Package.objects.all().order_by('-last_modified', '-id')
+    pagination_class = PackageCursorPagination
+    filter_fields = ('process_status', 'type', 'origin')
 
     def get_serializer_class(self):
         if self.action == 'list':
             return PackageListSerializer
         return PackageSerializer
 
+    def get_queryset(self):
+        """Filters packages, and loads only the fields the serializer returns."""
+        queryset = super().get_queryset()
+        if self.action == 'list':
+            queryset = queryset.filter(**self.get_filters())
+        requested = get_requested_fields(self.request)
+        if requested:
+            concrete_fields = [f.name for f in Package._meta.concrete_fields]
+            # The pagination cursor is built from last_modified.
+            return queryset.only('last_modified', *[name for name in concrete_fields if name in requested])
+        return queryset.defer(*getattr(self.get_serializer_class().Meta, 'exclude', ()))
+
+    def get_filters(self):
+        filters = {}
+        for name in self.filter_fields:
+            value = self.request.query_params.get(name)
+            if value:
+                filters[f"{name}__in"] = value.split(',')
+        if 'process_status__in' in filters:
+            try:
+                filters['process_status__in'] = [int(value) for value in filters['process_status__in']]
+            except ValueError:
+                raise ValidationError({"process_status": "Expected a comma-separated list of integers."})
+        return filters
+
     def create(self, request):
         """Handles data from Archivematica post-store callbacks.
 
@@ -38,16 +92,106 @@ class PackageViewSet(ModelViewSet):
                 {"detail": "Expected `identifier` to be in request data, none found"},
                 status=status.HTTP_400_BAD_REQUEST)
         archivematica_identifier = request.data["identifier"]
-        if not Package.objects.filter(archivematica_identifier=archivematica_identifier).exists():
-            Package.objects.create(
-                archivematica_identifier=archivematica_identifier,
-                process_status=Package.CREATED)
+        exists = Package.objects.filter(archivematica_identifier=archivematica_identifier).exists()
+        if not exists and self.create_package(archivematica_identifier):
             message = prepare_response(("Package created.", archivematica_identifier))
             return Response(message, status=status.HTTP_201_CREATED)
         return Response(
             {"detail": f"A package with the identifier {archivematica_identifier} already exists."},
             status=status.HTTP_400_BAD_REQUEST)
 
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        """Creates packages for many Archivematica identifiers at once.
+
+        Expects a list of `identifiers` to be passed in the request data.
+        Identifiers which already belong to a package are counted as
+        duplicates and skipped, including those created by a concurrent
+        request while this one is handled.
+        """
+        identifiers = request.data.get("identifiers")
+        if not isinstance(identifiers, list) or not all(isinstance(i, str) for i in identifiers):
+            return Response(
+                {"detail": "Expected `identifiers` to be a list in request data, none found"},
+                status=status.HTTP_400_BAD_REQUEST)
+        identifiers = list(dict.fromkeys(identifiers))
+        existing = set(
+            Package.objects.filter(archivematica_identifier__in=identifiers)
+            .values_list('archivematica_identifier', flat=True))
+        new_identifiers = [i for i in identifiers if i not in existing]
+        try:
+            with transaction.atomic():
+                Package.objects.bulk_create(
+                    [Package(archivematica_identifier=i, process_status=Package.CREATED) for i in new_identifiers],
+                    batch_size=1000)
+            created = new_identifiers
+        except IntegrityError:
+            # A concurrent request created some of the packages since the
+            # query above, so find out which by creating them one at a time.
+            created = [i for i in new_identifiers if self.create_package(i)]
+        message = prepare_response(("Packages created.", created))
+        message["duplicates"] = len(request.data["identifiers"]) - len(created)
+        return Response(message, status=status.HTTP_201_CREATED)
+
+    def create_package(self, archivematica_identifier):
+        """Creates a package. Returns False if the unique constraint shows a
+        package with the identifier already exists."""
+        try:
+            with transaction.atomic():
+                Package.objects.create(archivematica_identifier=archivematica_identifier, process_status=Package.CREATED)
+            return True
+        except IntegrityError:
+            return False
+
+
+class PipelineStatusView(APIView):
+    """Returns the number of packages in each process status, when the
+    longest waiting of them moved on to it, and how many of them did so
+    within each of a set of recent windows. Packages being processed by a
+    stage are dated from when they finished the previous one, and failed
+    attempts do not reset the time, so packages stuck in a stage show up.
+
+    Packages which have since moved on to another status are not counted, so
+    the windowed counts show recent arrivals still waiting in a status. The
+    throughput of the pipeline is given by `completed_within`, the number of
+    packages cleaned up within each window.
+
+    Counts are computed with a single grouped query and cached for
+    `PIPELINE_STATUS['cache_timeout']` seconds. Accepts GET requests only.
+    """
+    cache_key = 'pipeline-status'
+
+    def get(self, request):
+        pipeline_status = cache.get(self.cache_key)
+        if pipeline_status is None:
+            pipeline_status = self.get_pipeline_status()
+            cache.set(self.cache_key, pipeline_status, settings.PIPELINE_STATUS['cache_timeout'])
+        return Response(pipeline_status)
+
+    def get_pipeline_status(self):
+        now = timezone.now()
+        windows = settings.PIPELINE_STATUS['windows']
+        rows = list(
+            Package.objects.order_by('process_status').values('process_status')
+            .annotate(
+                count=Count('id'),
+                oldest=Min('status_changed_at'),
+                **{f"window_{name}": Count('id', filter=Q(status_changed_at__gte=now - timedelta(seconds=seconds)))
+                   for name, seconds in windows.items()}))
+        completed = next((row for row in rows if row["process_status"] == Package.CLEANED_UP), {})
+        return {
+            "generated": now,
+            "total": sum(row["count"] for row in rows),
+            "completed_within": {name: completed.get(f"window_{name}", 0) for name in windows},
+            "statuses": [{
+                "process_status": row["process_status"],
+                "count": row["count"],
+                "oldest": row["oldest"],
+                "oldest_age": (now - row["oldest"]).total_seconds(),
+                "entered_within": {name: row[f"window_{name}"] for name in windows},
+            } for row in rows],
+        }
+
 
 class AddDataView(RoutineView):
     """Downloads packages. Accepts POST requests only."""
@@ -59,6 +203,11 @@ class DownloadView(RoutineView):
     routine = DownloadRoutine
 
 
+class FetchView(RoutineView):
+    """Downloads packages while parsing their METS files. Accepts POST requests only."""
+    routine = FetchRoutine
+
+
 class ParseMETSView(RoutineView):
     """Downloads packages. Accepts POST requests only."""
     routine = ParseMETSRoutine
@@ -77,3 +226,8 @@ class DeliverView(RoutineView):
 class CleanupRequestView(RoutineView):
     """Sends request to clean up finished packages. Accepts POST requests only."""
     routine = CleanupRequester
+
+
+class ReapView(RoutineView):
+    """Returns packages with expired leases to their start status. Accepts POST requests only."""
+    routine = ReapRoutine
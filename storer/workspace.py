@@ -0,0 +1,111 @@
+import logging
+import re
+import shutil
+from functools import lru_cache
+from os import W_OK, access, listdir, makedirs, remove, rename, scandir
+from os.path import exists, isdir, join
+
+logger = logging.getLogger(__name__)
+
+UUID_PATTERN = '[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}'
+LEGACY_FILE = re.compile(r'^(?:METS\.(?P<mets>{uuid})\.xml|(?P<package>{uuid})\.(?:7z|tar))$'.format(uuid=UUID_PATTERN))
+
+
+class WorkspaceError(Exception):
+    pass
+
+
+class WorkspaceManager(object):
+    """Manages a workspace directory for each package under a root directory.
+
+    Every file written while processing a package, such as the downloaded
+    archive, the extracted METS file and the extracted DIP, is kept in the
+    package's workspace, so the workspace can be removed as a unit without
+    scanning the root directory.
+    """
+
+    def __init__(self, root):
+        if not isdir(root):
+            raise WorkspaceError('Directory does not exist', root)
+        if not access(root, W_OK):
+            raise WorkspaceError('Directory does not have write permissions', root)
+        self.root = root
+
+    def path(self, uuid, *parts):
+        """Returns the path of the workspace for `uuid`, or of a file in it."""
+        if not uuid or uuid in ('.', '..') or '/' in uuid:
+            raise WorkspaceError('Invalid package identifier', uuid)
+        return join(self.root, uuid, *parts)
+
+    def create(self, uuid):
+        """Creates the workspace for `uuid` if it does not exist, and returns its path."""
+        path = self.path(uuid)
+        makedirs(path, exist_ok=True)
+        return path
+
+    def remove(self, uuid):
+        """Removes the workspace for `uuid` and everything in it."""
+        path = self.path(uuid)
+        if exists(path):
+            logger.info("Removing workspace {} ({} bytes)".format(path, self.usage(uuid)))
+            shutil.rmtree(path)
+
+    def discard(self, uuid, *names):
+        """Removes files or directories from the workspace for `uuid`."""
+        for name in names:
+            path = self.path(uuid, name)
+            if isdir(path):
+                shutil.rmtree(path)
+            elif exists(path):
+                remove(path)
+
+    def adopt_legacy_files(self):
+        """Moves downloaded packages and METS files which earlier versions kept
+        directly in the root directory into the workspaces of their packages,
+        so packages which were in process when upgrading can be finished."""
+        for entry in scandir(self.root):
+            match = LEGACY_FILE.match(entry.name)
+            if match and entry.is_file(follow_symlinks=False):
+                uuid = match.group('mets') or match.group('package')
+                rename(entry.path, join(self.create(uuid), entry.name))
+                logger.info("Moved {} into workspace {}".format(entry.name, uuid))
+
+    def workspaces(self):
+        """Returns the identifiers of all existing workspaces."""
+        return [name for name in listdir(self.root) if isdir(join(self.root, name))]
+
+    def free_space(self):
+        """Returns the number of bytes available on the root directory's filesystem."""
+        return shutil.disk_usage(self.root).free
+
+    def total_space(self):
+        """Returns the size in bytes of the root directory's filesystem."""
+        return shutil.disk_usage(self.root).total
+
+    def usage(self, uuid=None):
+        """Returns the number of bytes used by the workspace for `uuid`, or by
+        all workspaces if no identifier is given."""
+        return directory_size(self.path(uuid) if uuid else self.root)
+
+
+def directory_size(path):
+    """Returns the total size in bytes of the files under `path`."""
+    total = 0
+    if not isdir(path):
+        return total
+    for entry in scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            total += directory_size(entry.path)
+        elif entry.is_file(follow_symlinks=False):
+            total += entry.stat(follow_symlinks=False).st_size
+    return total
+
+
+@lru_cache()
+def get_workspace_manager(root):
+    """Returns the workspace manager for `root`. The directory is checked, and
+    files left by earlier versions moved into workspaces, the first time it is
+    requested in each process."""
+    manager = WorkspaceManager(root)
+    manager.adopt_legacy_files()
+    return manager